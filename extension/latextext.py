@@ -4,12 +4,26 @@ from __future__ import print_function
 import sys
 import math
 import os
+import copy
 import glob
 import platform
 import subprocess
 import tempfile
 import shutil
 import re
+import hashlib
+import gzip
+import json
+import time
+import socket
+import threading
+import collections
+import contextlib
+from multiprocessing.pool import ThreadPool
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 from lxml import etree
 
 
@@ -20,6 +34,38 @@ PLATFORM = platform.system()
 STANDALONE = False
 LOG_LEVEL = 3
 
+# default maximum size of the render cache in megabytes
+CACHE_SIZE = 100
+
+# identities of the base formats of the Latex engines, determined on first use
+BASE_FORMATS = {}
+
+# available render backends: Latex engine, intermediate output format and
+# the tool converting it to SVG
+BACKENDS = {
+    "pdf2svg": ("pdflatex", "pdf"),
+    "dvisvgm": ("latex", "dvi"),
+}
+
+# render daemon: idle time in seconds before it shuts down and the number of
+# renderings it keeps in memory
+DAEMON_TIMEOUT = 1800
+DAEMON_MEMORY_ENTRIES = 2000
+
+# number of decimals of the coordinates in renderings
+PRECISION = 3
+
+# seconds a Latex or converter process may run before it is killed
+PROCESS_TIMEOUT = 60
+
+# number of texts compiled together when progress is reported
+PROGRESS_BATCH_SIZE = 25
+
+# watch mode: polling interval and the time to wait for further changes
+# after a file changed, in seconds
+WATCH_INTERVAL = 0.25
+WATCH_DEBOUNCE = 0.1
+
 
 ######################
 # XML namespace definitions
@@ -60,6 +106,8 @@ def log_error(*msg):
     log_message(log_level_error, *msg)
 
 
+# messages are only converted to strings if they are logged, so pass
+# objects and separate arguments instead of formatting them in hot paths
 def log_message(msg_level, *msg):
     global LOG_LEVEL
     if LOG_LEVEL > msg_level:
@@ -69,8 +117,7 @@ def log_message(msg_level, *msg):
     if STANDALONE:
         print(*msg)
     else:
-        for m in msg:
-            inkex.debug(m)
+        inkex.debug(' '.join(str(m) for m in msg))
 
 
 def set_log_level(l):
@@ -78,6 +125,84 @@ def set_log_level(l):
     LOG_LEVEL = l
 
 
+######################
+# Profiling
+#    Records the wall time of the pipeline stages and subprocesses and a set
+#    of counters as a trace in the Chrome trace event format, which can be
+#    opened with chrome://tracing or https://ui.perfetto.dev. Profiling is
+#    disabled unless a profiler is installed with set_profiler.
+class Profiler:
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.counters = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _event(self, name, phase, timestamp, **fields):
+        event = {'name': name, 'ph': phase, 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident, 'ts': (timestamp - self.start) * 1e6}
+        event.update(fields)
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._event(name, 'X', start, cat=category, dur=(time.time() - start) * 1e6, args=args)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            value = self.counters[name]
+        self._event(name, 'C', time.time(), args={name: value})
+
+    def write(self, path):
+        trace = {'traceEvents': self.events, 'displayTimeUnit': 'ms', 'otherData': self.counters}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+PROFILER = None
+NO_SPAN = _NoSpan()
+
+
+def set_profiler(profiler):
+    global PROFILER
+    PROFILER = profiler
+
+
+# time a stage of the pipeline, arguments are stored with the trace event
+def profile_span(name, category="stage", **args):
+    if PROFILER is None:
+        return NO_SPAN
+    return PROFILER.span(name, category, **args)
+
+
+def profile_count(name, n=1):
+    if PROFILER is not None:
+        PROFILER.count(name, n)
+
+
+######################
+#  Use inotify in watch mode if available, poll otherwise
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
 ######################
 #  Check if we are in the inkscape extension folder
 try:
@@ -88,116 +213,333 @@ except ImportError:
     STANDALONE = True
 
 
+######################
+# SVG number formatting
+
+# shortest representation of a number with the given number of decimals
+def format_number(value, precision):
+    text = "%.*f" % (precision, value)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return text
+
+
+_path_token_re = re.compile(r"([MmLlHhVvCcSsQqTtAaZz])|([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)")
+
+# number of arguments of every path command
+PATH_ARGUMENTS = {'M': 2, 'L': 2, 'T': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'A': 7, 'Z': 0}
+
+
+def transform_path(d, precision, dx=0.0, dy=0.0):
+    """
+    Round the coordinates of SVG path data and translate all absolute
+    coordinates by (dx, dy). Returns None if the path data is not valid.
+    """
+    tokens = []
+    command = None
+    index = 0
+    pos = 0
+    for match in _path_token_re.finditer(d):
+        if d[pos:match.start()].strip(" ,\t\r\n"):
+            return None
+        pos = match.end()
+        letter, number = match.groups()
+        if letter:
+            command = letter
+            index = 0
+            tokens.append(letter)
+            continue
+        if command is None or PATH_ARGUMENTS[command.upper()] == 0:
+            return None
+        upper = command.upper()
+        arg = index % PATH_ARGUMENTS[upper]
+        value = float(number)
+        # the first pair of a path starting with a relative move is absolute
+        if command.isupper() or (tokens[0] == 'm' and len(tokens) <= 2):
+            if upper == 'H' or (upper == 'A' and arg == 5) or (upper not in 'VA' and arg % 2 == 0):
+                value += dx
+            elif upper == 'V' or (upper == 'A' and arg == 6) or (upper != 'A' and arg % 2 == 1):
+                value += dy
+        tokens.append(format_number(value, precision))
+        index += 1
+    if d[pos:].strip(" ,\t\r\n"):
+        return None
+    return " ".join(tokens)
+
+
 ######################
 # SVG transformer
 #    Parse, modify and create SVG transform attributes
 class SvgTransformer:
 
-    # matrix multiplication helper function
-    def _matmult(self, a, b):
-        zip_b = zip(*b)
-        # uncomment next line if python 3 :
-        # zip_b = list(zip_b)
-        return [[sum(ele_a * ele_b for ele_a, ele_b in zip(row_a, col_b))
-                 for col_b in zip_b] for row_a in a]
-
-    # init a neutral transform matrix
-    def _init_matrix(self):
-        matrix = [[0] * 3 for i in range(3)]
-        matrix[0][0] = 1
-        matrix[1][1] = 1
-        matrix[2][2] = 1
-        return matrix
-
-    # parse an SVG transform command and extract its type and parameters
+    # a transform is stored as the six coefficients (a, b, c, d, e, f) of
+    # the SVG matrix [[a, c, e], [b, d, f], [0, 0, 1]]
+    IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+    _command_re = re.compile(r"\s*,?\s*(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)\s*,?")
+    _number_re = re.compile(r"[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?")
+
+    # multiply two matrices given as coefficient tuples
+    @staticmethod
+    def _matmult(m, n):
+        return (m[0] * n[0] + m[2] * n[1],
+                m[1] * n[0] + m[3] * n[1],
+                m[0] * n[2] + m[2] * n[3],
+                m[1] * n[2] + m[3] * n[3],
+                m[0] * n[4] + m[2] * n[5] + m[4],
+                m[1] * n[4] + m[3] * n[5] + m[5])
+
+    # parse an SVG transform list like "translate(10 20) rotate(45)" into a
+    # single matrix, returns None if the string is not a valid transform list
     def _parse_transform(self, attrStr):
-        if "translate" in attrStr:
-            coordStr = attrStr[10:-1]
-            coordList = list([float(coord) for coord in coordStr.split(",") if coord])
-            return coordList, "translate"
-        elif "matrix" in attrStr:
-            coordStr = attrStr[7:-1]
-            coordList = list([float(coord) for coord in coordStr.split(",") if coord])
-            return coordList, "matrix"
-        elif "rotate" in attrStr:
-            coordStr = attrStr[8:-1]
-            coordList = list([float(coord) for coord in coordStr.split(",") if coord])
-            return coordList, "rotate"
-        elif "scale" in attrStr:
-            coordStr = attrStr[6:-1]
-            coordList = list([float(coord) for coord in coordStr.split(",") if coord])
-            if len(coordList) == 1:
-                coordList.append(coordList[0])
-            return coordList, "scale"
-        else:
-            return None, None
+        matrix = self.IDENTITY
+        pos = 0
+        while pos < len(attrStr):
+            match = self._command_re.match(attrStr, pos)
+            if match is None:
+                if attrStr[pos:].strip():
+                    return None
+                break
+            pos = match.end()
+            name = match.group(1)
+            args = [float(v) for v in self._number_re.findall(match.group(2))]
+
+            if name == "matrix" and len(args) == 6:
+                m = tuple(args)
+            elif name == "translate" and len(args) in (1, 2):
+                m = (1.0, 0.0, 0.0, 1.0, args[0], args[1] if len(args) == 2 else 0.0)
+            elif name == "scale" and len(args) in (1, 2):
+                m = (args[0], 0.0, 0.0, args[-1], 0.0, 0.0)
+            elif name == "rotate" and len(args) in (1, 3):
+                angle = math.radians(args[0])
+                m = (math.cos(angle), math.sin(angle), -math.sin(angle), math.cos(angle), 0.0, 0.0)
+                if len(args) == 3:
+                    # rotate(a, cx, cy) = translate(cx, cy) rotate(a) translate(-cx, -cy)
+                    m = self._matmult(self._matmult((1.0, 0.0, 0.0, 1.0, args[1], args[2]), m),
+                                      (1.0, 0.0, 0.0, 1.0, -args[1], -args[2]))
+            elif name == "skewX" and len(args) == 1:
+                m = (1.0, 0.0, math.tan(math.radians(args[0])), 1.0, 0.0, 0.0)
+            elif name == "skewY" and len(args) == 1:
+                m = (1.0, math.tan(math.radians(args[0])), 0.0, 1.0, 0.0, 0.0)
+            else:
+                return None
+            matrix = self._matmult(matrix, m)
+        return matrix
 
     # constructor
     def __init__(self, attrStr=""):
-        self.matrix = self._init_matrix()
-        self.transform_type = ""
+        self.matrix = self.IDENTITY
         if attrStr:
             self.apply_transform(attrStr)
 
-    # apply a transform given in form of a SVG transform command
+    # apply a transform given in form of a SVG transform list
     def apply_transform(self, attrStr):
-        coordList, transform_type = self._parse_transform(attrStr)
-        if transform_type == "translate":
-            new_matrix = self._init_matrix()
-            new_matrix[0][2] = coordList[0]
-            new_matrix[1][2] = coordList[1]
-            self.matrix = self._matmult(new_matrix, self.matrix)
-        elif transform_type == "matrix":
-            log_debug(coordList)
-            new_matrix = self._init_matrix()
-            log_debug(new_matrix)
-            new_matrix[0][0] = coordList[0]
-            new_matrix[1][0] = coordList[1]
-            new_matrix[0][1] = coordList[2]
-            new_matrix[1][1] = coordList[3]
-            new_matrix[0][2] = coordList[4]
-            new_matrix[1][2] = coordList[5]
-            self.matrix = self._matmult(new_matrix, self.matrix)
-        elif transform_type == "rotate":
-            log_debug(coordList)
-            new_matrix = self._init_matrix()
-            log_debug(new_matrix)
-            new_matrix[0][0] = math.cos(math.radians(coordList[0]))
-            new_matrix[1][0] = math.sin(-1.0 * math.radians(coordList[0]))
-            new_matrix[0][1] = math.sin(math.radians(coordList[0]))
-            new_matrix[1][1] = math.cos(math.radians(coordList[0]))
-            self.matrix = self._matmult(new_matrix, self.matrix)
-        elif transform_type == "scale":
-            log_debug(coordList)
-            new_matrix = self._init_matrix()
-            log_debug(new_matrix)
-            new_matrix[0][0] = coordList[0]
-            new_matrix[1][1] = coordList[1]
-            self.matrix = self._matmult(new_matrix, self.matrix)
-        else:
+        matrix = self._parse_transform(attrStr)
+        if matrix is None:
             log_error("\nUnknown transform: " + attrStr)
             raise RuntimeError()
+        self.matrix = self._matmult(matrix, self.matrix)
+
+    # apply the transform of another SvgTransformer
+    def apply_transformer(self, other):
+        self.matrix = self._matmult(other.matrix, self.matrix)
 
     # apply scaling
     def scale(self, factor):
-        new_matrix = self._init_matrix()
-        new_matrix[0][0] = factor
-        new_matrix[1][1] = factor
-        self.matrix = self._matmult(new_matrix, self.matrix)
+        self.matrix = self._matmult((factor, 0.0, 0.0, factor, 0.0, 0.0), self.matrix)
 
     # apply translation
     def translate(self, x, y):
-        new_matrix = self._init_matrix()
-        new_matrix[0][2] = x
-        new_matrix[1][2] = y
-        self.matrix = self._matmult(new_matrix, self.matrix)
+        self.matrix = self._matmult((1.0, 0.0, 0.0, 1.0, x, y), self.matrix)
 
     def get_translation(self):
-        return (self.matrix[0][2], self.matrix[1][2])
+        return (self.matrix[4], self.matrix[5])
+
+    # the inverse transform, None if the transform is not invertible
+    def inverse(self):
+        a, b, c, d, e, f = self.matrix
+        det = a * d - b * c
+        if abs(det) < 1e-12:
+            return None
+        inverse = SvgTransformer()
+        inverse.matrix = (d / det, -b / det, -c / det, a / det, (c * f - d * e) / det, (b * e - a * f) / det)
+        return inverse
+
+    # return current transformation as SVG transform string, as translate or
+    # scale if possible and as matrix otherwise
+    def __str__(self):
+        return self.to_string()
+
+    def to_string(self, precision=6):
+        a, b, c, d, e, f = [format_number(v, precision) for v in self.matrix]
+        if (a, b, c, d) == ('1', '0', '0', '1'):
+            return "translate(%s,%s)" % (e, f)
+        if (b, c, e, f) == ('0', '0', '0', '0'):
+            return "scale(%s,%s)" % (a, d)
+        return "matrix(%s,%s,%s,%s,%s,%s)" % (a, b, c, d, e, f)
 
-    # return current transformation as SVG transform matrix string
-    def to_string(self):
-        return "matrix(%f,%f,%f,%f,%f,%f)" % (self.matrix[0][0], self.matrix[1][0], self.matrix[0][1], self.matrix[1][1], self.matrix[0][2], self.matrix[1][2])
+
+######################
+# SVG compaction
+#    Post-processing of converted pages: rounds coordinates, removes clip
+#    paths covering the whole page, unused definitions and groups without
+#    attributes, and optionally bakes translations into coordinates.
+class SvgCompactor:
+
+    _url_re = re.compile(r"url\(#([^)]+)\)")
+    _rounded_attributes = ('x', 'y', 'width', 'height', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry')
+
+    def __init__(self, precision=PRECISION, bake_transforms=False):
+        self.precision = precision
+        self.bake_transforms = bake_transforms
+
+    @staticmethod
+    def _localname(el):
+        return etree.QName(el).localname if isinstance(el.tag, str) else None
+
+    # compact a page, page_box is the (x, y, width, height) of the page
+    def compact(self, group, page_box=None):
+        if page_box is not None:
+            self.remove_page_clips(group, page_box)
+        self.remove_unused_defs(group)
+        self.flatten_groups(group)
+        if self.bake_transforms:
+            self.bake(group)
+        self.round_numbers(group)
+        return group
+
+    # ids referenced by links or url(#...) values
+    @classmethod
+    def references(cls, group):
+        refs = set()
+        for el in group.iter():
+            if not isinstance(el.tag, str):
+                continue
+            for name, value in el.attrib.items():
+                if name == '{%s}href' % XLINK_NS and value.startswith('#'):
+                    refs.add(value[1:])
+                elif 'url(' in value:
+                    refs.update(cls._url_re.findall(value))
+        return refs
+
+    def _path_bounds(self, d):
+        tokens = [match.group(0) for match in _path_token_re.finditer(d)]
+        if any(t.isalpha() and t not in 'MLZ' for t in tokens):
+            return None
+        numbers = [float(t) for t in tokens if not t.isalpha()]
+        if not numbers or len(numbers) % 2:
+            return None
+        return (min(numbers[0::2]), min(numbers[1::2]), max(numbers[0::2]), max(numbers[1::2]))
+
+    def _covers(self, shape, box, tolerance=0.01):
+        name = self._localname(shape)
+        if 'transform' in shape.attrib:
+            return False
+        if name == 'rect':
+            try:
+                x, y = float(shape.get('x', 0)), float(shape.get('y', 0))
+                bounds = (x, y, x + float(shape.get('width')), y + float(shape.get('height')))
+            except (TypeError, ValueError):
+                return False
+        elif name == 'path':
+            bounds = self._path_bounds(shape.get('d', ''))
+            if bounds is None:
+                return False
+        else:
+            return False
+        return bounds[0] <= box[0] + tolerance and bounds[1] <= box[1] + tolerance and \
+            bounds[2] >= box[0] + box[2] - tolerance and bounds[3] >= box[1] + box[3] - tolerance
+
+    # clipping to the page does not change anything for the content of a page
+    def remove_page_clips(self, group, page_box):
+        clips = set(clip.get('id') for clip in group.iter('{%s}clipPath' % SVG_NS)
+                    if len(clip) == 1 and self._covers(clip[0], page_box))
+        if not clips:
+            return
+        for el in group.iter():
+            match = self._url_re.match(el.get('clip-path', "")) if isinstance(el.tag, str) else None
+            if match is None or match.group(1) not in clips:
+                continue
+            # the clip path is in the coordinates of the element
+            ancestors = [el] + [a for a in el.iterancestors()]
+            ancestors = ancestors[:ancestors.index(group)]
+            if not any('transform' in a.attrib for a in ancestors):
+                del el.attrib['clip-path']
+
+    # remove definitions nobody refers to, which may make others unused
+    def remove_unused_defs(self, group):
+        while True:
+            refs = self.references(group)
+            unused = [el for defs in group.iter('{%s}defs' % SVG_NS) for el in defs.iter()
+                      if el is not defs and isinstance(el.tag, str) and el.get('id') not in (None, "")
+                      and el.get('id') not in refs]
+            if not unused:
+                break
+            for el in unused:
+                el.getparent().remove(el)
+        for defs in list(group.iter('{%s}defs' % SVG_NS)):
+            for g in defs.findall('{%s}g' % SVG_NS):
+                if len(g) == 0:
+                    defs.remove(g)
+            if len(defs) == 0:
+                defs.getparent().remove(defs)
+
+    # replace groups without attributes by their children, remove empty ones
+    def flatten_groups(self, group):
+        refs = self.references(group)
+        for g in list(group.iter('{%s}g' % SVG_NS)):
+            parent = g.getparent()
+            if g is group or g.get('id') in refs or self._localname(parent) == 'defs':
+                continue
+            if len(g) == 0:
+                parent.remove(g)
+            elif not set(g.attrib) - set(['id']):
+                index = parent.index(g)
+                for child in reversed(list(g)):
+                    parent.insert(index, child)
+                parent.remove(g)
+
+    # move translations into the coordinates of paths, uses and rectangles
+    def bake(self, group):
+        for el in group.iter():
+            name = self._localname(el)
+            if name not in ('path', 'use', 'rect') or 'transform' not in el.attrib:
+                continue
+            matrix = SvgTransformer()._parse_transform(el.attrib['transform'])
+            if matrix is None or [format_number(v, 9) for v in matrix[:4]] != ['1', '0', '0', '1']:
+                continue
+            if name == 'path':
+                d = transform_path(el.get('d', ""), self.precision, matrix[4], matrix[5])
+                if d is None:
+                    continue
+                el.attrib['d'] = d
+            else:
+                el.attrib['x'] = format_number(float(el.get('x', 0)) + matrix[4], self.precision)
+                el.attrib['y'] = format_number(float(el.get('y', 0)) + matrix[5], self.precision)
+            del el.attrib['transform']
+
+    def round_numbers(self, group):
+        for el in group.iter():
+            if not isinstance(el.tag, str):
+                continue
+            if 'd' in el.attrib and self._localname(el) == 'path':
+                d = transform_path(el.attrib['d'], self.precision)
+                if d is not None:
+                    el.attrib['d'] = d
+            for name in self._rounded_attributes:
+                if name in el.attrib:
+                    try:
+                        el.attrib[name] = format_number(float(el.attrib[name]), self.precision)
+                    except ValueError:
+                        pass
+            if 'transform' in el.attrib:
+                transformer = SvgTransformer()
+                matrix = transformer._parse_transform(el.attrib['transform'])
+                if matrix is not None:
+                    transformer.matrix = matrix
+                    el.attrib['transform'] = transformer.to_string(max(self.precision, 6))
 
 
 # https://gist.github.com/Leechael/8144525
@@ -223,9 +565,11 @@ class dict2obj(dict):
 #    a new layer
 class SvgProcessor:
 
-    def __init__(self, infile, options):
+    def __init__(self, infile, options, cache=None):
         self.options = options
         self.svg_input = infile
+        self.cache = cache
+        self.cancel_event = threading.Event()
 
         self.defaults = dict2obj({"scale": 1.0, "depth": 0.0, "fontsize": 10, 
                                   "preamble": "","packages": "amsmath,amssymb","math": False, 
@@ -233,7 +577,7 @@ class SvgProcessor:
 
         # load from file or use existing document root
         if isinstance(infile, str):
-            tree = etree.parse(self.svg_input)
+            tree = parse_document(self.svg_input)
             self.docroot = tree.getroot()
         else:
             self.docroot = infile.getroot()
@@ -288,22 +632,68 @@ class SvgProcessor:
             el.attrib['{%s}href' % XLINK_NS] = "#" + prefix + "-" + old_href[1:]
         node.attrib['id'] = prefix
 
+    # index the direct children of the render layer by their id
+    def index_layer(self, render_layer):
+        self.render_index = dict((el.get('id'), el) for el in render_layer if el.get('id') is not None)
+
     def insert_node(self, node, root, prefix):
         # check if node already exists
-        old_node = None
-        for el in root.getiterator():
-            if 'id' in el.attrib and el.attrib['id'] == prefix:
-                old_node = el
-                root.remove(el)
+        old_node = self.render_index.pop(prefix, None)
+        if old_node is not None:
+            root.remove(old_node)
+
+        # remember the computed placement, the transform may be changed by
+        # the user afterwards
+        if 'transform' in node.attrib:
+            node.attrib['{%s}placement' % RENDLTX_NS] = node.attrib['transform']
 
         # transfer style and transforms etc.
         if old_node is not None:
             if 'transform' in old_node.attrib:
-                node.attrib['transform'] = old_node.attrib['transform']
+                node.attrib['transform'] = self.transfer_transform(old_node, node.get('transform'))
             if 'style' in old_node.attrib:
                 self.apply_style(node, old_node.attrib['style'])
 
         root.append(node)
+        self.render_index[prefix] = node
+
+    # the transform of a rendering at a new placement: the user's own
+    # adjustment of the old rendering (its transform relative to the
+    # placement it was inserted with) applied to the new placement
+    def transfer_transform(self, old_node, placement):
+        old_placement = old_node.get('{%s}placement' % RENDLTX_NS)
+        if old_placement is None or placement is None:
+            # rendered by an older version, keep the transform as it is
+            return old_node.attrib['transform']
+        inverse = SvgTransformer(old_placement).inverse()
+        if inverse is None:
+            return placement
+
+        adjustment = SvgTransformer(old_node.attrib['transform'])
+        adjustment.matrix = SvgTransformer._matmult(adjustment.matrix, inverse.matrix)
+        transform = SvgTransformer(placement)
+        transform.apply_transformer(adjustment)
+        return transform.to_string()
+
+    # move an unchanged rendering along with its text element, which may
+    # have been moved or transformed since it was rendered
+    def refresh_placement(self, node, txt, ctm=None):
+        old_placement = node.get('{%s}placement' % RENDLTX_NS)
+        if old_placement is None:
+            return
+        if etree.QName(node).localname == 'use':
+            symbol = self.glyph_index.get(node.get('{%s}href' % XLINK_NS, "")[1:])
+            anchor = self.baseline_anchor(symbol) if symbol is not None else None
+        else:
+            anchor = self.baseline_anchor(node)
+        placement = self.placement_transform(txt, ctm, anchor or (0, 0)).to_string()
+        if placement == old_placement:
+            return
+        if 'transform' in node.attrib:
+            node.attrib['transform'] = self.transfer_transform(node, placement)
+        else:
+            node.attrib['transform'] = placement
+        node.attrib['{%s}placement' % RENDLTX_NS] = placement
 
     def apply_style(self, node, style):
         # TODO: strip spaces from style string before splitting
@@ -314,19 +704,140 @@ class SvgProcessor:
         #    style_render += "fill:" + properties['fill'] + ';'
 
         node.attrib['style'] = style
+        self.strip_group_styles(node)
+
+    # remove the styles of the groups in a rendering, so they inherit the
+    # style of the rendering
+    def strip_group_styles(self, node):
         for g in node.findall('.//{%s}g' % SVG_NS):
             if 'style' in g.attrib:
                 g.attrib.pop('style')
 
         return node
 
-    def align_placement(self, node, txt):
-        if 'x' in txt.attrib and 'y' in txt.attrib:
-            aligned_pos = (float(txt.attrib['x']), float(txt.attrib['y']))
-        else:
-            aligned_pos = (0, 0)
+    # the elements to search for text elements with their depth and current
+    # transformation matrix, the document root unless elements are selected
+    # with --id or --select. Selected renderings stand for their text element.
+    def selection_roots(self):
+        ids = getattr(self.options, 'ids', None) or []
+        select = getattr(self.options, 'select', None)
+        if not ids and not select:
+            return [(self.docroot, 0, SvgTransformer())]
+
+        selected = []
+        for node_id in ids:
+            selected.extend(self.docroot.xpath("//*[@id=$id]", id=node_id))
+        if select:
+            try:
+                selected.extend(el for el in self.docroot.xpath(select, namespaces=NSS)
+                                if isinstance(el, etree._Element))
+            except etree.XPathError as err:
+                log_error("Invalid selection %s: %s" % (select, err))
+                raise RuntimeError()
+
+        elements = []
+        for el in selected:
+            ancestors = list(el.iterancestors())
+            layer_ids = [a.get('id') for a in ancestors]
+            if 'ltx-render-layer' in layer_ids:
+                # a rendering, select the text element it was rendered from
+                rendering = ([el] + ancestors)[layer_ids.index('ltx-render-layer')]
+                rendering_id = rendering.get('id', '')
+                el = None
+                if rendering_id.startswith('lx-'):
+                    found = self.docroot.xpath("//*[@id=$id]", id=rendering_id[3:])
+                    el = found[0] if found else None
+            if el is not None and el not in elements:
+                elements.append(el)
+
+        roots = []
+        selected_set = set(elements)
+        for el in elements:
+            ancestors = list(el.iterancestors())
+            if selected_set.intersection(ancestors):
+                # contained in another selected element
+                continue
+            ctm = SvgTransformer()
+            for ancestor in reversed(ancestors):
+                if 'transform' in ancestor.attrib:
+                    t = SvgTransformer(ancestor.attrib['transform'])
+                    t.apply_transformer(ctm)
+                    ctm = t
+            roots.append((el, len(ancestors), ctm))
+        log_debug(len(roots), "selected elements")
+        return roots
+
+    # walk the document once and yield all text elements to be rendered
+    # together with the transform accumulated from their ancestors
+    def iter_text_nodes(self):
+        max_depth = None
+        if self.options.depth > 0:
+            max_depth = self.options.depth + 1
+
+        stack = list(reversed(self.selection_roots()))
+        while stack:
+            el, depth, ctm = stack.pop()
+            if el.tag == '{%s}text' % SVG_NS:
+                yield el, ctm
+                continue
+            if el.get('id') == 'ltx-render-layer':
+                continue
+            if max_depth is not None and depth + 1 > max_depth:
+                continue
+
+            if 'transform' in el.attrib:
+                child_ctm = SvgTransformer(el.attrib['transform'])
+                child_ctm.apply_transformer(ctm)
+            else:
+                child_ctm = ctm
+            # push in reverse to visit the children in document order
+            for child in reversed(el):
+                if isinstance(child.tag, str):
+                    stack.append((child, depth + 1, child_ctm))
+
+    def align_placement(self, node, txt, ctm=None):
+        # without metrics reported by Latex, anchor at the top/left most element
+        if not self.normalize_baseline(node) and not self.normalize_position(node):
+            log_debug("Warning: Element has no x/y position assigned!")
+            return node
 
-        # remove position offset, anchor is top/right most element
+        transform = self.placement_transform(txt, ctm)
+        log_debug(transform)
+        node.attrib['transform'] = transform.to_string()
+
+        return node
+
+    # the start of the baseline of a rendering, as reported by Latex
+    def baseline_anchor(self, node):
+        baseline = node.get('{%s}baseline' % RENDLTX_NS)
+        if baseline is None:
+            return None
+        try:
+            x, y = [float(v) for v in baseline.split()]
+        except ValueError:
+            return None
+        return (x, y)
+
+    # move the start of the baseline of a rendering to the origin with an
+    # inner translation, so the placement transform only depends on the text
+    # element and not on the size of the content. Returns False if Latex
+    # reported no metrics.
+    def normalize_baseline(self, node):
+        anchor = self.baseline_anchor(node)
+        if anchor is None:
+            return False
+        if anchor != (0, 0):
+            inner = etree.Element('{%s}g' % SVG_NS)
+            inner.attrib['transform'] = "translate(%s,%s)" % (format_number(-anchor[0], self.options.precision),
+                                                              format_number(-anchor[1], self.options.precision))
+            inner.extend(list(node))
+            node.append(inner)
+            node.attrib['{%s}baseline' % RENDLTX_NS] = "0 0"
+        return True
+
+    # remove the position offset of a rendering, the anchor is the top/right
+    # most element. Returns False if no element has a position.
+    def normalize_position(self, node):
         pos_list = list()
         for el in node.getiterator():
             if 'x' in el.attrib and 'y' in el.attrib:
@@ -334,38 +845,63 @@ class SvgProcessor:
                 pos_list.append(el_pos)
 
         if not pos_list:
-            log_debug("Warning: Element has no x/y position assigned!")
-            return node
+            return False
 
         pos_list.sort()
         pos_offset = pos_list[0]
 
+        precision = self.options.precision
         for el in node.getiterator():
             if 'transform' in el.attrib:
                 t = SvgTransformer(el.attrib['transform'])
                 (tx, ty) = t.get_translation()
                 t.translate(-pos_offset[0], -pos_offset[1])
-                el.attrib['transform'] = t.to_string()
+                el.attrib['transform'] = t.to_string(max(precision, 6))
+            elif el.tag == '{%s}path' % SVG_NS and 'd' in el.attrib and self._in_content(el, node):
+                # paths with baked transforms carry their position in the path data
+                d = transform_path(el.attrib['d'], precision, -pos_offset[0], -pos_offset[1])
+                if d is not None:
+                    el.attrib['d'] = d
             if 'x' in el.attrib:
-                el.attrib['x'] = str(float(el.attrib['x']) - pos_offset[0])
+                el.attrib['x'] = format_number(float(el.attrib['x']) - pos_offset[0], precision)
             if 'y' in el.attrib:
-                el.attrib['y'] = str(float(el.attrib['y']) - pos_offset[1])
+                el.attrib['y'] = format_number(float(el.attrib['y']) - pos_offset[1], precision)
+        return True
+
+    # whether an element is drawn in the coordinates of a rendering, i.e. it
+    # is neither a definition nor inside a transformed group
+    def _in_content(self, el, node):
+        for ancestor in el.iterancestors():
+            if ancestor is node:
+                return True
+            if 'transform' in ancestor.attrib or \
+                    etree.QName(ancestor).localname in ('defs', 'symbol', 'clipPath', 'mask', 'pattern'):
+                return False
+        return True
+
+    # the transform placing the anchor of a rendering at a text element
+    def placement_transform(self, txt, ctm=None, anchor=(0, 0)):
+        if 'x' in txt.attrib and 'y' in txt.attrib:
+            aligned_pos = (float(txt.attrib['x']), float(txt.attrib['y']))
+        else:
+            aligned_pos = (0, 0)
 
         transform = SvgTransformer()
-        transform.scale(self.unit_conversion_factor)
+        transform.translate(-anchor[0], -anchor[1])
+        transform.scale(self.unit_conversion_factor * self.options.scale)
         transform.translate(aligned_pos[0], aligned_pos[1])
 
         if 'transform' in txt.attrib:
             transform.apply_transform(txt.attrib['transform'])
 
-        for el in txt.iterancestors():
-            if 'transform' in el.attrib:
-                transform.apply_transform(el.attrib['transform'])
-
-        log_debug(transform.to_string())
-        node.attrib['transform'] = transform.to_string()
+        if ctm is not None:
+            transform.apply_transformer(ctm)
+        else:
+            for el in txt.iterancestors():
+                if 'transform' in el.attrib:
+                    transform.apply_transform(el.attrib['transform'])
 
-        return node
+        return transform
 
     def get_parameters(self, render_layer):
         if render_layer is None:
@@ -424,9 +960,292 @@ class SvgProcessor:
         if self.options.math is not None:
             render_layer.attrib['{%s}math' % RENDLTX_NS] = str(self.options.math)
 
-    def run(self):
+    # hash of all options and files which influence the rendering of a text
+    def options_digest(self):
+        h = hashlib.sha1()
+        for value in (self.options.preamble, self.options.packages, self.options.fontsize, self.options.scale,
+                      self.options.backend, self.options.precision, self.options.bake_transforms):
+            _hash_update(h, repr(value) + "\n")
+        _hash_update(h, files_digest(preamble_dependencies(self.options.preamble)))
+        return h.hexdigest()
+
+    def render_digest(self, latex_string, options_digest):
+        h = hashlib.sha1()
+        _hash_update(h, options_digest)
+        _hash_update(h, latex_string)
+        return h.hexdigest()
+
+    # a render layer created by run() is not in the SVG namespace until the
+    # document is parsed again
+    def find_render_layer(self):
+        render_layer = self.docroot.find("{%s}g[@id='ltx-render-layer']" % SVG_NS)
+        if render_layer is None:
+            render_layer = self.docroot.find("g[@id='ltx-render-layer']")
+        return render_layer
+
+    # digest of everything a run of the whole document depends on: the
+    # options, the preamble files, the sources and placements of all text
+    # elements and the renderings present. A run does not change a document whose fingerprint
+    # is the one stored by the previous run.
+    def fingerprint(self, extra=""):
+        h = hashlib.sha1()
+        _hash_update(h, self.options_digest())
+        _hash_update(h, "%r %r %r\n" % (self.options.math, self.options.newline, self.options.depth))
+        for txt, ctm in self.iter_text_nodes():
+            _hash_update(h, "%s\n%s\n%s\n" % (txt.get('id'), self.latex_source(txt),
+                                               self.placement_transform(txt, ctm).to_string()))
+        render_layer = self.find_render_layer()
+        if render_layer is not None:
+            for el in render_layer:
+                _hash_update(h, "%s\n" % el.get('id'))
+        _hash_update(h, extra)
+        return h.hexdigest()
+
+    # store the fingerprint in the render layer, None removes it
+    def store_fingerprint(self, fingerprint):
+        render_layer = self.find_render_layer()
+        if render_layer is None:
+            return
+        if fingerprint is None:
+            render_layer.attrib.pop('{%s}fingerprint' % RENDLTX_NS, None)
+        else:
+            render_layer.attrib['{%s}fingerprint' % RENDLTX_NS] = fingerprint
+
+    # identify a glyph definition by its outline data, the element tags and
+    # their attributes other than the id. Unlike the serialized element they
+    # do not depend on the namespace declarations in scope.
+    def glyph_id(self, glyph):
+        h = hashlib.sha1()
+        for el in glyph.iter():
+            if isinstance(el.tag, str):
+                attributes = sorted((etree.QName(name).localname, value) for name, value in el.attrib.items()
+                                    if name != 'id')
+                _hash_update(h, "%s\0%r\0" % (etree.QName(el).localname, attributes))
+        return 'ltx-glyph-' + h.hexdigest()[:16]
+
+    def _glyphs(self, defs):
+        # pdf2svg puts <symbol>s into a <g> in the defs, dvisvgm <path>s
+        glyphs = []
+        for el in defs:
+            tag = etree.QName(el).localname if isinstance(el.tag, str) else None
+            if tag == 'g' and 'id' not in el.attrib:
+                glyphs.extend(self._glyphs(el))
+            elif tag in ('symbol', 'path') and 'id' in el.attrib:
+                glyphs.append(el)
+        return glyphs
+
+    # move the glyph definitions of a rendering into the shared definitions
+    # of the render layer, identical glyphs are only stored once
+    def share_glyphs(self, node, glyph_defs):
+        renamed = {}
+        for defs in node.findall('.//{%s}defs' % SVG_NS):
+            for glyph in self._glyphs(defs):
+                shared_id = self.glyph_id(glyph)
+                renamed[glyph.attrib['id']] = shared_id
+                glyph.getparent().remove(glyph)
+                if shared_id not in self.glyph_index:
+                    glyph.attrib['id'] = shared_id
+                    glyph.tail = None
+                    glyph_defs.append(glyph)
+                    self.glyph_index[shared_id] = glyph
+            # remove what is left empty
+            for g in defs.findall('{%s}g' % SVG_NS):
+                if len(g) == 0:
+                    defs.remove(g)
+            if len(defs) == 0:
+                defs.getparent().remove(defs)
+
+        for el in node.iter('{%s}use' % SVG_NS):
+            href = el.get('{%s}href' % XLINK_NS, "")
+            if href[1:] in renamed:
+                el.attrib['{%s}href' % XLINK_NS] = '#' + renamed[href[1:]]
+
+    # id of the symbol of a rendering shared by identical text elements
+    def snippet_id(self, digest):
+        return 'ltx-snippet-' + digest[:16]
+
+    # store a rendering as a symbol in the shared definitions
+    def add_symbol(self, node, symbol_id, glyph_defs):
+        if not self.normalize_baseline(node):
+            self.normalize_position(node)
+        self.add_id_prefix(node, symbol_id)
+        self.share_glyphs(node, glyph_defs)
+        # the clones are styled through their <use>
+        self.strip_group_styles(node)
+        symbol = etree.SubElement(glyph_defs, '{%s}symbol' % SVG_NS)
+        symbol.attrib['id'] = symbol_id
+        symbol.attrib['overflow'] = 'visible'
+        for name in ('baseline', 'width', 'height', 'depth'):
+            if '{%s}%s' % (RENDLTX_NS, name) in node.attrib:
+                symbol.attrib['{%s}%s' % (RENDLTX_NS, name)] = node.attrib['{%s}%s' % (RENDLTX_NS, name)]
+        symbol.extend(list(node))
+        self.glyph_index[symbol_id] = symbol
+
+    # a clone of a shared rendering placed at a text element
+    def clone_symbol(self, symbol_id, txt, ctm=None):
+        use = etree.Element('{%s}use' % SVG_NS)
+        use.attrib['id'] = 'lx-' + txt.attrib['id']
+        use.attrib['{%s}href' % XLINK_NS] = '#' + symbol_id
+        anchor = self.baseline_anchor(self.glyph_index[symbol_id]) or (0, 0)
+        use.attrib['transform'] = self.placement_transform(txt, ctm, anchor).to_string()
+        return use
+
+    # remove definitions which nothing references anymore in one pass over
+    # the render layer: shared glyphs and symbols (a glyph may only be used
+    # by a symbol) and the clip paths of the renderings
+    def remove_unused_defs(self, render_layer, glyph_defs):
+        refs = set()
+        for child in render_layer:
+            if child is not glyph_defs:
+                refs |= SvgCompactor.references(child)
+
+        used = set()
+        stack = list(refs)
+        while stack:
+            ref = stack.pop()
+            if ref in used:
+                continue
+            used.add(ref)
+            glyph = self.glyph_index.get(ref)
+            if glyph is not None:
+                stack.extend(SvgCompactor.references(glyph))
+
+        for glyph in list(glyph_defs):
+            if glyph.get('id') not in used:
+                glyph_defs.remove(glyph)
+                self.glyph_index.pop(glyph.get('id'), None)
+
+        for child in render_layer:
+            if child is glyph_defs:
+                continue
+            for clip in list(child.iter('{%s}clipPath' % SVG_NS)):
+                if clip.get('id') not in used:
+                    clip.getparent().remove(clip)
+
+    def remove_rendering(self, render_layer, node):
+        render_layer.remove(node)
+        self.render_index.pop(node.get('id'), None)
+
+    # remove the renderings of text elements which were deleted or renamed
+    def remove_orphans(self, render_layer):
+        text_ids = set(txt.get('id') for txt in self.docroot.iter('{%s}text' % SVG_NS))
+        orphans = [el for el in render_layer
+                   if el.get('id', "").startswith('lx-') and el.get('id')[3:] not in text_ids]
+        for node in orphans:
+            log_debug("Removing orphaned rendering", node.get('id'))
+            self.remove_rendering(render_layer, node)
+        return len(orphans)
+
+    # remove the renderings of the selected text elements, or all renderings
+    # if nothing is selected
+    def clean(self, render_layer):
+        selected = getattr(self.options, 'ids', None) or getattr(self.options, 'select', None)
+        if selected:
+            nodes = [self.render_index.get('lx-' + txt.attrib['id']) for txt, ctm in self.iter_text_nodes()]
+            nodes = [node for node in nodes if node is not None]
+        else:
+            nodes = [el for el in render_layer if el.get('id', "").startswith('lx-')]
+        for node in nodes:
+            self.remove_rendering(render_layer, node)
+        return len(nodes)
+
+    # the Latex code of a text element, None if the element is empty
+    def latex_source(self, txt, options=None):
+        options = options or self.options
+        if options.newline is True:
+            #line_ending = '\\newline\n'
+            line_ending = '\\\\\n'
+        else:
+            line_ending = '\n'
 
-        lat2svg = Latex2SvgRenderer()
+        latex_string = ""
+        txt_empty = True
+        if txt.text:
+            latex_string += txt.text + line_ending
+            txt_empty = False
+        tspans = txt.findall('{%s}tspan' % SVG_NS)
+        for ts in tspans:
+            if ts.text:
+                latex_string += ts.text + line_ending
+                txt_empty = False
+            else:
+                latex_string += line_ending
+        if txt_empty:
+            return None
+        if options.math and latex_string[0] != '$':
+            latex_string = '$' + latex_string + '$'
+        return latex_string
+
+    def renderer(self, options=None):
+        options = options or self.options
+        daemon_socket = None
+        if RenderDaemon.available():
+            daemon_socket = RenderDaemon.socket_path_for(options.cache_dir)
+        cache = self.cache
+        if cache is None:
+            cache = RenderCache(options.cache_dir, options.cache_size)
+        return Latex2SvgRenderer(cache, options.jobs,
+                                 not options.no_format, daemon_socket, backend=options.backend,
+                                 precision=options.precision, bake_transforms=options.bake_transforms,
+                                 timeout=options.timeout)
+
+    # render a single text element with the given options (by default those
+    # of the processor) into a standalone SVG document of its box, e.g. for a
+    # preview. A renderer can be passed to be able to cancel the rendering.
+    # Returns None for an empty element.
+    def render_preview(self, txt, options=None, renderer=None):
+        options = options or self.options
+        latex_string = self.latex_source(txt, options)
+        if latex_string is None:
+            return None
+        renderer = renderer or self.renderer(options)
+        rendergroup = renderer.render(latex_string, options.preamble, options.packages, options.fontsize)
+
+        svg = etree.Element('{%s}svg' % SVG_NS, nsmap={None: SVG_NS, 'xlink': XLINK_NS})
+        anchor = self.baseline_anchor(rendergroup)
+        if anchor is not None:
+            width, height, depth = [float(rendergroup.get('{%s}%s' % (RENDLTX_NS, name)))
+                                    for name in ('width', 'height', 'depth')]
+            svg.attrib['viewBox'] = "%g %g %g %g" % (anchor[0], anchor[1] - height, width, height + depth)
+        else:
+            # no metrics reported by Latex, show a line of text
+            self.normalize_position(rendergroup)
+            width, height, depth = 100.0, 10.0, 2.0
+            svg.attrib['viewBox'] = "0 0 %g %g" % (width, height + depth)
+        svg.attrib['width'] = "%gpt" % (width * options.scale)
+        svg.attrib['height'] = "%gpt" % ((height + depth) * options.scale)
+        svg.append(rendergroup)
+        return svg
+
+    # compile a batch of texts, returns the renderings and the error messages
+    # (None for the texts which succeeded). If the whole batch fails (e.g. the
+    # preamble is broken) every text is reported as failed.
+    def render_chunk(self, lat2svg, latex_codes):
+        try:
+            with profile_span("render", nodes=len(latex_codes)):
+                rendergroups = lat2svg.render_batch(latex_codes, self.options.preamble,
+                                                    self.options.packages, self.options.fontsize)
+        except RuntimeError as err:
+            error = getattr(err, 'message', None) or "rendering failed"
+            return [None] * len(latex_codes), [error] * len(latex_codes)
+        return rendergroups, [lat2svg.errors.get(i) for i in range(len(latex_codes))]
+
+    # stop a run in another thread before the next text element
+    def cancel(self):
+        self.cancel_event.set()
+
+    # render all text elements, progress is called with the number of text
+    # elements done and the total number before each one and at the end
+    def run(self, progress=None):
+
+        lat2svg = self.renderer()
+        self.rendered_count = 0
+        self.skipped_count = 0
+        self.removed_count = 0
+        self.reclaimed_bytes = 0
+        self.cancelled = False
+        # (id, error message) of the text elements which failed to render
+        self.failures = []
 
         # check for existing render layer or add new one
         render_layer = self.docroot.find("{%s}g[@id='ltx-render-layer']" % SVG_NS)
@@ -440,60 +1259,531 @@ class SvgProcessor:
         else:
             log_debug("Using a previous render layer...")
 
-        if self.options.newline is True:
-            #line_ending = '\\newline\n'
-            line_ending = '\\\\\n'
-        else:
-            line_ending = '\n'
-
-        text_nodes = self.docroot.findall('.//{%s}text' % SVG_NS)
-        log_debug(str(len(text_nodes)) + " text nodes were found.")
-        for txt in text_nodes:
-            if self.options.depth > 0 and txt.xpath('count(ancestor::*)') > self.options.depth + 1:
-                    continue
-
-            log_debug("ID: " + txt.attrib.get('id', None))
-
-            latex_string = ""
-            txt_empty = True
-            if txt.text:
-                latex_string += txt.text + line_ending
-                txt_empty = False
-            tspans = txt.findall('{%s}tspan' % SVG_NS)
-            for ts in tspans:
-                if ts.text:
-                    latex_string += ts.text + line_ending
-                    txt_empty = False
-                else:
-                    latex_string += line_ending
-            if txt_empty:
+        self.index_layer(render_layer)
+
+        # glyph definitions shared by all renderings
+        glyph_defs = self.render_index.get('ltx-glyph-defs')
+        if glyph_defs is None:
+            glyph_defs = etree.Element('defs')
+            glyph_defs.attrib['id'] = 'ltx-glyph-defs'
+            render_layer.insert(0, glyph_defs)
+            self.render_index['ltx-glyph-defs'] = glyph_defs
+        self.glyph_index = dict((glyph.get('id'), glyph) for glyph in glyph_defs)
+
+        if self.options.clean:
+            size = len(etree.tostring(render_layer))
+            self.removed_count = self.clean(render_layer)
+            self.remove_unused_defs(render_layer, glyph_defs)
+            self.reclaimed_bytes = size - len(etree.tostring(render_layer))
+            log_debug(self.removed_count, "renderings removed,", self.reclaimed_bytes, "bytes reclaimed")
+            return self.docroot
+
+        # renderings of deleted or renamed text elements
+        with profile_span("remove_orphans"):
+            orphan_count = self.remove_orphans(render_layer)
+        if orphan_count:
+            log_info("%d orphaned renderings removed" % orphan_count)
+
+        options_digest = self.options_digest()
+        render_jobs = []
+
+        text_count = 0
+        for txt, ctm in self.iter_text_nodes():
+            text_count += 1
+            log_debug("ID:", txt.attrib.get('id', None))
+
+            latex_string = self.latex_source(txt)
+            if latex_string is None:
                 log_debug("Empty text element, skipping...")
                 continue
-            if self.options.math and latex_string[0] is not '$':
-                latex_string = '$' + latex_string + '$'
             log_debug(latex_string)
-            rendergroup = lat2svg.render(latex_string, self.options.preamble, self.options.packages, self.options.fontsize, self.options.scale)
-            rendergroup = self.align_placement(rendergroup, txt)
-            # rendergroup = self.apply_style(rendergroup, txt)
-            self.add_id_prefix(rendergroup, 'lx-' + txt.attrib['id'])
-            self.insert_node(rendergroup, render_layer, 'lx-' + txt.attrib['id'])
 
+            # skip texts which did not change since the last run, only their
+            # placement is updated in case the text element was moved
+            digest = self.render_digest(latex_string, options_digest)
+            old_node = self.render_index.get('lx-' + txt.attrib['id'])
+            if old_node is not None and old_node.get('{%s}hash' % RENDLTX_NS) == digest:
+                log_debug("Unchanged text element, skipping...")
+                self.skipped_count += 1
+                self.refresh_placement(old_node, txt, ctm)
+                continue
+
+            render_jobs.append((txt, ctm, latex_string, digest))
+
+        log_debug(text_count, "text nodes were found.")
+        profile_count("nodes seen", text_count)
+        profile_count("nodes skipped", self.skipped_count)
+
+        # identical texts are compiled only once. A text which occurs several
+        # times is stored as a symbol in the shared definitions and every
+        # occurrence becomes a <use> clone of it.
+        occurrences = collections.Counter(job[3] for job in render_jobs)
+        compile_index = {}
+        latex_codes = []
+        for txt, ctm, latex_string, digest in render_jobs:
+            if digest not in compile_index and self.snippet_id(digest) not in self.glyph_index:
+                compile_index[digest] = len(latex_codes)
+                latex_codes.append(latex_string)
+        profile_count("nodes deduplicated", len(render_jobs) - len(latex_codes))
+
+        # render all remaining texts at once and insert them in document order.
+        # With a progress callback the texts are compiled in smaller batches,
+        # so progress is reported while rendering and a cancelled run stops
+        # at the next text element, keeping the ones inserted so far.
+        batch_size = len(latex_codes) if progress is None else PROGRESS_BATCH_SIZE
+        rendergroups = []
+        errors = []
+        for n, (txt, ctm, latex_string, digest) in enumerate(render_jobs):
+            if progress is not None:
+                progress(n, len(render_jobs))
+            if self.cancel_event.is_set():
+                log_info("Cancelled after %d of %d text nodes" % (n, len(render_jobs)))
+                self.cancelled = True
+                break
+            if compile_index.get(digest, -1) >= len(rendergroups):
+                chunk = latex_codes[len(rendergroups):len(rendergroups) + batch_size]
+                chunk_groups, chunk_errors = self.render_chunk(lat2svg, chunk)
+                rendergroups.extend(chunk_groups)
+                errors.extend(chunk_errors)
+
+            node_id = txt.attrib['id']
+            symbol_id = self.snippet_id(digest)
+            if symbol_id in self.glyph_index:
+                rendergroup = self.clone_symbol(symbol_id, txt, ctm)
+            else:
+                rendergroup = rendergroups[compile_index[digest]]
+                if rendergroup is None:
+                    # keep a previous rendering, the text is tried again next time
+                    error = errors[compile_index[digest]]
+                    log_error("Failed to render text element %s: %s" % (node_id, error))
+                    self.failures.append((node_id, error))
+                    continue
+                if occurrences[digest] > 1:
+                    with profile_span("add_symbol", node=node_id):
+                        self.add_symbol(rendergroup, symbol_id, glyph_defs)
+                    rendergroup = self.clone_symbol(symbol_id, txt, ctm)
+                else:
+                    with profile_span("align_placement", node=node_id):
+                        rendergroup = self.align_placement(rendergroup, txt, ctm)
+                    # rendergroup = self.apply_style(rendergroup, txt)
+                    with profile_span("add_id_prefix", node=node_id):
+                        self.add_id_prefix(rendergroup, 'lx-' + node_id)
+                    with profile_span("share_glyphs", node=node_id):
+                        self.share_glyphs(rendergroup, glyph_defs)
+            with profile_span("insert_node", node=node_id):
+                self.insert_node(rendergroup, render_layer, 'lx-' + node_id)
+            rendergroup.attrib['{%s}hash' % RENDLTX_NS] = digest
+            self.rendered_count += 1
+        else:
+            if progress is not None:
+                progress(len(render_jobs), len(render_jobs))
+
+        if render_jobs or orphan_count:
+            with profile_span("remove_unused_defs"):
+                self.remove_unused_defs(render_layer, glyph_defs)
+
+        if self.failures:
+            profile_count("nodes failed", len(self.failures))
+        log_info("%d text nodes rendered, %d unchanged text nodes skipped, %d failed"
+                 % (self.rendered_count, self.skipped_count, len(self.failures)))
         self.store_parameters(render_layer)
         return self.docroot
 
 
+######################
+# Helpers to locate the external tools and the files a preamble depends on
+
+def latex_command(name):
+    if PLATFORM == MAC:
+        return os.path.join('/Library/TeX/texbin', name)
+    return name
+
+
+def pdf2svg_command():
+    if PLATFORM == WINDOWS:
+        return os.path.join(os.path.realpath(EXT_PATH), 'pdf2svg')
+    return 'pdf2svg'
+
+
+def find_executable(cmd):
+    """
+    Resolve a command to the executable that would be started for it, or
+    None if it cannot be found.
+    """
+    if os.path.dirname(cmd):
+        candidates = [cmd]
+    else:
+        candidates = [os.path.join(p, cmd) for p in os.environ.get('PATH', '').split(os.pathsep) if p]
+    for path in candidates:
+        for ext in ('', '.exe'):
+            if os.path.isfile(path + ext) and os.access(path + ext, os.X_OK):
+                return path + ext
+    return None
+
+
+def tool_identity(cmd):
+    """
+    Identify the installed version of a tool by the path, size and
+    modification time of its executable, without spawning a process.
+    """
+    path = find_executable(cmd)
+    if path is None:
+        return cmd + ":missing"
+    st = os.stat(os.path.realpath(path))
+    return "%s:%d:%d" % (path, st.st_size, int(st.st_mtime))
+
+
+def preamble_dependencies(preamble_file, cwd=None):
+    """
+    Return the preamble file and all files it loads with \\input or \\include,
+    recursively. Files which cannot be found are ignored.
+    """
+    cwd = cwd or os.getcwd()
+    deps = []
+    pending = [os.path.join(cwd, preamble_file)] if preamble_file else []
+    while pending:
+        path = pending.pop(0)
+        if path in deps or not os.path.isfile(path):
+            continue
+        deps.append(path)
+        with open(path, 'r') as f:
+            content = f.read()
+        content = re.sub(r"(?<!\\)%.*", "", content)
+        for name in re.findall(r"\\(?:input|include)\s*\{([^}]+)\}", content):
+            name = name.strip()
+            for base in (os.path.dirname(path), cwd):
+                candidate = os.path.join(base, name)
+                if not os.path.isfile(candidate) and not os.path.splitext(name)[1]:
+                    candidate += '.tex'
+                if os.path.isfile(candidate):
+                    pending.append(os.path.normpath(candidate))
+                    break
+    return deps
+
+
+def files_digest(paths):
+    h = hashlib.sha1()
+    for path in paths:
+        _hash_update(h, path + "\n")
+        with open(path, 'rb') as f:
+            _hash_update(h, f.read())
+    return h.hexdigest()
+
+
+# the preamble file of a document and all files it loads, the preamble is
+# taken from the render layer if none is given
+def document_dependencies(path, preamble=None):
+    if preamble is None:
+        try:
+            root = parse_document(path).getroot()
+        except (IOError, OSError, etree.XMLSyntaxError):
+            return []
+        render_layer = root.find("{%s}g[@id='ltx-render-layer']" % SVG_NS)
+        if render_layer is not None:
+            preamble = render_layer.get('{%s}preamble' % RENDLTX_NS)
+    return preamble_dependencies(preamble)
+
+
+def _hash_update(h, data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    h.update(data)
+
+
+######################
+# Reading and writing documents, .svgz files are gzip compressed
+
+def is_compressed(path):
+    return path.lower().endswith('.svgz')
+
+
+def parse_document(path):
+    if is_compressed(path):
+        with gzip.open(path, 'rb') as f:
+            return etree.parse(f)
+    return etree.parse(path)
+
+
+# move a file over another one in one step where the platform allows it
+def _replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if PLATFORM == WINDOWS and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def write_document(root, path, pretty_print=True):
+    """
+    Serialize a document directly into a temporary file next to the target,
+    which then replaces the target in one step, so the target is never left
+    half written.
+    """
+    out_dir = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if is_compressed(path):
+                with gzip.GzipFile(os.path.basename(path)[:-1], 'wb', fileobj=f) as zf:
+                    etree.ElementTree(root).write(zf, encoding='utf-8', xml_declaration=True,
+                                                  pretty_print=pretty_print)
+            else:
+                etree.ElementTree(root).write(f, encoding='utf-8', xml_declaration=True,
+                                              pretty_print=pretty_print)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # keep the permissions of an existing file, mkstemp creates private files
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+
+        _replace_file(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# the fingerprint stored in a document by the last run, None if there is none
+def stored_fingerprint(root):
+    render_layer = root.find("{%s}g[@id='ltx-render-layer']" % SVG_NS)
+    if render_layer is None:
+        return None
+    return render_layer.get('{%s}fingerprint' % RENDLTX_NS)
+
+
+######################
+# Render cache
+#    Persistent, content addressed storage of rendered SVG groups and the
+#    precompiled Latex formats. Both are evicted in least recently used order
+#    once the size limit is hit.
+class RenderCache:
+
+    def __init__(self, cache_dir=None, max_size=CACHE_SIZE, memory_entries=0):
+        if not cache_dir:
+            cache_dir = self.default_dir()
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        # optional in-memory LRU of serialized entries in front of the files
+        self.memory_entries = memory_entries
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_dir():
+        if PLATFORM == WINDOWS:
+            base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+        else:
+            base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(base, 'latextext')
+
+    # compute the cache key for a TeX source and a digest of everything else
+    # it depends on (see Latex2SvgRenderer.config_digest)
+    def key(self, texwrapper, config_digest):
+        h = hashlib.sha1()
+        _hash_update(h, texwrapper)
+        _hash_update(h, config_digest)
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.svg')
+
+    # return (atime, size, path) of all cached SVG groups and formats
+    def _entries(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            # formats being dumped are no entries yet
+            dirnames[:] = [name for name in dirnames if not name.startswith('.tmp-')]
+            for name in filenames:
+                if name.endswith('.svg') or name.endswith('.fmt'):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_atime, st.st_size, path))
+        return entries
+
+    # return the cached SVG group for a key or None
+    def get(self, key):
+        with self._lock:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory[key] = data
+                self.hits += 1
+                return etree.fromstring(data)
+
+        path = self._entry_path(key)
+        try:
+            node = etree.parse(path).getroot()
+            os.utime(path, None)
+        except (IOError, OSError, etree.XMLSyntaxError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._remember(key, etree.tostring(node))
+        return node
+
+    def _remember(self, key, data):
+        if not self.memory_entries:
+            return
+        with self._lock:
+            self._memory[key] = data
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    # store an SVG group, the write is atomic so concurrent runs can share a cache
+    def put(self, key, node):
+        data = etree.tostring(node)
+        self._remember(key, data)
+        path = self._entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as err:
+            log_debug("Could not write cache entry:", err)
+            return
+        self.added(path)
+
+    # account for a file added to the cache directory and prune if the cache
+    # got too large
+    def added(self, path):
+        if self._size is None:
+            self._size = sum(e[1] for e in self._entries())
+        else:
+            try:
+                self._size += os.path.getsize(path)
+            except OSError:
+                return
+        if self._size > self.max_size:
+            self.prune()
+
+    # evict least recently used entries until the cache fits into max_size
+    def prune(self, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+        entries = sorted(self._entries())
+        size = sum(e[1] for e in entries)
+        removed = 0
+        for atime, entry_size, path in entries:
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        self._size = size
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        formats = [e for e in entries if e[2].endswith('.fmt')]
+        return dict2obj({"location": self.cache_dir,
+                         "entries": len(entries) - len(formats),
+                         "formats": len(formats),
+                         "size": sum(e[1] for e in entries),
+                         "max_size": self.max_size,
+                         "hits": self.hits,
+                         "misses": self.misses})
+
+
+######################
+# Latex errors
+
+# raised when Latex reports an error, page is the page (snippet) of the
+# document the error occurred on if it is known
+class LatexError(RuntimeError):
+    def __init__(self, message, page=None, in_header=False):
+        RuntimeError.__init__(self, message)
+        self.message = message
+        self.page = page
+        self.in_header = in_header
+
+
+# a Latex or converter process which was killed after running too long
+class ProcessTimeout(LatexError):
+    pass
+
+
+# a rendering which was cancelled by Latex2SvgRenderer.cancel
+class RenderCancelled(RuntimeError):
+    pass
+
+
+# return the first error message in the output of a Latex run and the line
+# number of the source it refers to
+def parse_latex_error(output):
+    lines = output.splitlines()
+    for n, line in enumerate(lines):
+        if line.startswith('! '):
+            for context in lines[n + 1:n + 20]:
+                match = re.match(r"^l\.([0-9]+) (.*)$", context)
+                if match:
+                    return "%s %s" % (line[2:], match.group(2).strip()), int(match.group(1))
+            return line[2:], None
+    return None, None
+
+
 ######################
 #  Render some latex code and return it as a SVG XML group node
 class Latex2SvgRenderer:
 
-    def _exec_command(self, cmd, ok_return_value=0):
+    def __init__(self, cache=None, jobs=1, use_format=True, daemon_socket=None, cwd=None, backend="pdf2svg",
+                 precision=PRECISION, bake_transforms=False, timeout=PROCESS_TIMEOUT):
+        self.cache = cache
+        self.jobs = max(1, jobs or 1)
+        self.use_format = use_format
+        self.daemon_socket = daemon_socket
+        self.cwd = cwd
+        self.backend = backend
+        self.engine, self.output_format = BACKENDS[backend]
+        self.compactor = SvgCompactor(precision, bake_transforms)
+        self.timeout = timeout
+        # error messages of the snippets of the last batch which failed
+        self.errors = {}
+        # the running processes, killed on cancel
+        self.cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def _converter_command(self):
+        if self.backend == "dvisvgm":
+            return latex_command('dvisvgm')
+        return pdf2svg_command()
+
+    def _exec_command(self, cmd, ok_return_value=0, env=None):
         """
         Run given command, check return value, and return
         concatenated stdout and stderr.
         :param cmd: Command to execute
         :param ok_return_value: The expected return value after successful completion
+        :param env: Environment of the command, defaults to the current one
+        :raises ProcessTimeout: If the command runs longer than self.timeout seconds
+        :raises RenderCancelled: If the rendering is cancelled
         """
 
+        killed = []
+        if self.cancelled:
+            raise RenderCancelled()
+
         try:
             # hides the command window for cli tools that are run (in Windows)
             info = None
@@ -502,40 +1792,79 @@ class Latex2SvgRenderer:
                 info.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 info.wShowWindow = subprocess.SW_HIDE
 
-            p = subprocess.Popen(cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 stdin=subprocess.PIPE,
-                                 startupinfo=info)
-            out, err = p.communicate()
+            with profile_span(os.path.basename(cmd[0]), "subprocess", cmd=' '.join(cmd)):
+                p = subprocess.Popen(cmd,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     stdin=subprocess.PIPE,
+                                     startupinfo=info,
+                                     env=env,
+                                     cwd=self.cwd)
+                with self._lock:
+                    self._processes.add(p)
+                    if self.cancelled:
+                        self._kill(p, [])
+                timer = None
+                if self.timeout:
+                    timer = threading.Timer(self.timeout, self._kill, (p, killed))
+                    timer.start()
+                try:
+                    out, err = p.communicate()
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    with self._lock:
+                        self._processes.discard(p)
         except OSError as err:
             log_error("\nCommand \"%s\" > failed: %s" % (' '.join(cmd), err))
             raise RuntimeError()
 
+        if self.cancelled:
+            raise RenderCancelled()
+
+        if killed:
+            log_debug("Command killed after", self.timeout, "s:", *cmd)
+            raise ProcessTimeout("%s timed out after %g s" % (os.path.basename(cmd[0]), self.timeout))
+
         if ok_return_value is not None and p.returncode != ok_return_value:
             log_error("\nCommand \"%s\" failed (code %d): \n\n %s" % (' '.join(cmd), p.returncode, out + err))
             raise RuntimeError()
         return out + err
 
-    # render given latex code and return the result as an SVG group element
-    def render(self, latex_code, preamble_file=None, package_list="", fontsize=10, scale=1):
-
-        # Options pass to LaTeX-related commands
-        latexOpts = ['-interaction=nonstopmode',
-                     '-halt-on-error']
-
-        preamble = ""
-        if preamble_file:
-            log_debug("Loading preamble from " + preamble_file)
-            with open(preamble_file, 'r') as preamble_file:
-                preamble = preamble_file.read()
-
+    # stop the rendering from another thread, the running processes are
+    # killed and the rendering raises RenderCancelled. A render daemon keeps
+    # compiling what it was sent.
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for p in self._processes:
+                self._kill(p, [])
+
+    @staticmethod
+    def _kill(p, killed):
+        killed.append(p.pid)
+        try:
+            p.kill()
+        except OSError:
+            # the process exited in the meantime
+            pass
+
+    # digest of the preamble files and tools a rendering depends on
+    def config_digest(self, preamble_file, cwd=None):
+        h = hashlib.sha1()
+        _hash_update(h, files_digest(preamble_dependencies(preamble_file, cwd)))
+        for tool in (latex_command(self.engine), self._converter_command()):
+            _hash_update(h, tool_identity(tool))
+        return h.hexdigest()
+
+    # build the header of a Latex document up to \begin{document}
+    def tex_header(self, preamble="", package_list="", fontsize=10):
         if fontsize in [10, 11, 12]:
             doc_class = "article"
         else:
             doc_class = "scrartcl"
 
-        texwrapper = \
+        return \
 r"""\documentclass[%dpt]{%s}
 \usepackage[a0paper]{geometry}
 \newlength\tindent
@@ -544,63 +1873,526 @@ r"""\documentclass[%dpt]{%s}
 \renewcommand{\indent}{\hspace*{\tindent}}
 %s
 \usepackage{%s}
+\usepackage{varwidth}
+\usepackage[active,tightpage%s]{preview}
+\setlength\PreviewBorder{0pt}
 \pagestyle{empty}
-\AtBeginDocument{\pdfliteral { %s 0 0 %s 0 0 cm }}
-\begin{document}
-    %s
+""" \
+        % (fontsize, doc_class, preamble, package_list, ",dvips" if self.output_format == "dvi" else "")
+
+    # build the body of a Latex document with one page per snippet, every
+    # page is cropped to the box of the snippet by the preview package
+    def tex_body(self, latex_codes):
+        pages = ["\\begin{preview}\\begin{varwidth}[t]{\\linewidth}\n    " + latex_code +
+                 "\n\\end{varwidth}\\end{preview}" for latex_code in latex_codes]
+
+        return \
+r"""\begin{document}
+%s
 \end{document}""" \
-        % (fontsize, doc_class, preamble, package_list, scale, scale, latex_code)
+        % "\n".join(pages)
+
+    # build a Latex document with one page per snippet
+    def tex_document(self, latex_codes, preamble="", package_list="", fontsize=10):
+        return self.tex_header(preamble, package_list, fontsize) + self.tex_body(latex_codes)
+
+    def _format_dir(self):
+        return os.path.join(self.cache.cache_dir, 'formats')
+
+    def _format_env(self):
+        # search the format directory first, the trailing separator appends
+        # the default search path
+        env = dict(os.environ)
+        env['TEXFORMATS'] = self._format_dir() + os.pathsep
+        return env
+
+    # return the name of a precompiled format containing the given document
+    # header, the format is dumped on first use and None is returned if that
+    # is not possible
+    def _format(self, header, config_digest):
+        if not self.use_format or self.cache is None:
+            return None
+
+        if self.engine not in BASE_FORMATS:
+            # the base format changes whenever the TeX installation is updated
+            try:
+                path = self._exec_command([latex_command('kpsewhich'), '-engine=pdftex', self.engine + '.fmt'])
+                BASE_FORMATS[self.engine] = tool_identity(path.decode('utf-8').strip())
+            except RuntimeError:
+                BASE_FORMATS[self.engine] = ""
 
-        # Convert TeX to PDF
+        fmt_name = 'ltx-' + self.cache.key(header, config_digest + BASE_FORMATS[self.engine])[:16]
+        fmt_path = os.path.join(self._format_dir(), fmt_name + '.fmt')
+        if os.path.exists(fmt_path):
+            try:
+                # keep the format from being evicted as least recently used
+                os.utime(fmt_path, None)
+            except OSError:
+                pass
+            return fmt_name
+
+        log_debug("Creating format", fmt_name)
+        # dump the format next to its final location and move it into place
+        # in one step, so concurrent runs never use a partially written one
+        try:
+            os.makedirs(self._format_dir())
+        except OSError:
+            pass
+        try:
+            tmp_path = tempfile.mkdtemp(dir=self._format_dir(), prefix='.tmp-')
+        except (IOError, OSError):
+            return None
+        try:
+            fmtsrc_path = os.path.join(tmp_path, 'fmt.tex')
+            with open(fmtsrc_path, 'w') as f:
+                f.write(header + "\\dump\n")
+            cmd = [latex_command(self.engine), '-ini', '-interaction=nonstopmode', '-halt-on-error',
+                   '-jobname=' + fmt_name, '-output-directory=' + tmp_path, '&' + self.engine, fmtsrc_path]
+            self._exec_command(cmd, ok_return_value=None)
+            if not os.path.exists(os.path.join(tmp_path, fmt_name + '.fmt')):
+                log_debug("Could not create format, compiling without")
+                return None
+            _replace_file(os.path.join(tmp_path, fmt_name + '.fmt'), fmt_path)
+            self.cache.added(fmt_path)
+        except (RuntimeError, IOError, OSError):
+            return None
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return fmt_name
+
+    # render given latex code and return the result as an SVG group element,
+    # raises a LatexError with the message if it fails
+    def render(self, latex_code, preamble_file=None, package_list="", fontsize=10):
+        rendergroup = self.render_batch([latex_code], preamble_file, package_list, fontsize)[0]
+        if rendergroup is None:
+            raise LatexError(self.errors[0])
+        return rendergroup
+
+    # render a list of latex snippets sharing the same configuration and
+    # return a list of SVG group elements, all snippets which are not
+    # found in the cache are compiled together in a single document. The
+    # renderings are unscaled and in units of pt. Snippets which fail to
+    # compile are None and their Latex errors are found in self.errors.
+    def render_batch(self, latex_codes, preamble_file=None, package_list="", fontsize=10):
+        self.errors = {}
 
+        # let a running render daemon do the work if there is one
+        if self.daemon_socket is not None and latex_codes:
+            rendergroups = self._render_remote(latex_codes, preamble_file, package_list, fontsize)
+            if rendergroups is not None:
+                return rendergroups
+
+        preamble = ""
+        if preamble_file:
+            log_debug("Loading preamble from", preamble_file)
+            with open(os.path.join(self.cwd or "", preamble_file), 'r') as f:
+                preamble = f.read()
+
+        rendergroups = [None] * len(latex_codes)
+        config_digest = self.config_digest(preamble_file, self.cwd)
+        # renderings depend on the post-processing as well
+        output_digest = "%s:%d:%d" % (config_digest, self.compactor.precision, self.compactor.bake_transforms)
+
+        # Use previous renderings of the same source if available
+        cache_keys = [None] * len(latex_codes)
+        if self.cache is not None:
+            for i, latex_code in enumerate(latex_codes):
+                texwrapper = self.tex_document([latex_code], preamble, package_list, fontsize)
+                cache_keys[i] = self.cache.key(texwrapper, output_digest)
+                rendergroups[i] = self.cache.get(cache_keys[i])
+                if rendergroups[i] is not None:
+                    log_debug("Using cached rendering", cache_keys[i])
+                    profile_count("nodes cached")
+
+        missing = [i for i, group in enumerate(rendergroups) if group is None]
+        if not missing:
+            return rendergroups
+        profile_count("nodes compiled", len(missing))
+
+        header = self.tex_header(preamble, package_list, fontsize)
+        with profile_span("format"):
+            fmt_name = self._format(header, config_digest)
+
+        # split the snippets into one chunk per worker, each chunk is
+        # compiled in its own workspace and the results keep their order
+        chunk_size = -(-len(missing) // self.jobs)
+        chunks = [[latex_codes[i] for i in missing[n:n + chunk_size]] for n in range(0, len(missing), chunk_size)]
+        if len(chunks) > 1:
+            pool = ThreadPool(len(chunks))
+            try:
+                results = pool.map(lambda chunk: self._compile_tolerant(chunk, header, fmt_name), chunks)
+            finally:
+                pool.close()
+        else:
+            results = [self._compile_tolerant(chunks[0], header, fmt_name)]
+        pages = [page for result in results for page in result[0]]
+        errors = [error for result in results for error in result[1]]
+
+        for i, rendergroup, error in zip(missing, pages, errors):
+            if rendergroup is None:
+                self.errors[i] = error
+                continue
+            rendergroups[i] = rendergroup
+            if cache_keys[i] is not None:
+                self.cache.put(cache_keys[i], rendergroup)
+
+        return rendergroups
+
+    # send a render request to the daemon, returns None if it is not available
+    def _render_remote(self, latex_codes, preamble_file, package_list, fontsize):
+        if not os.path.exists(self.daemon_socket):
+            return None
+        request = {'cmd': 'render', 'latex_codes': latex_codes, 'preamble_file': preamble_file,
+                   'package_list': package_list, 'fontsize': fontsize, 'backend': self.backend,
+                   'jobs': self.jobs, 'use_format': self.use_format, 'cwd': self.cwd or os.getcwd(),
+                   'precision': self.compactor.precision, 'bake_transforms': self.compactor.bake_transforms,
+                   'timeout': self.timeout}
+        try:
+            reply = RenderDaemon.request(self.daemon_socket, request)
+        except (socket.error, ValueError) as err:
+            log_debug("Render daemon not available:", err)
+            return None
+        if not reply.get('ok'):
+            # render again locally to get the Latex errors reported
+            log_debug("Render daemon failed:", reply.get('error'))
+            return None
+        log_debug("Rendered by daemon")
+        self.errors = dict((int(i), error) for i, error in reply.get('errors', {}).items())
+        return [etree.fromstring(group.encode('utf-8')) if group is not None else None for group in reply['groups']]
+
+    # compile snippets in one document like _compile_snippets, but a snippet
+    # which fails does not stop the others. It is located with the line of
+    # the Latex error and confirmed on its own, or found by bisecting the
+    # snippets if the line is not known (e.g. after a timeout) or pointed at
+    # a snippet which compiles. Returns the pages and the error messages,
+    # with None for the snippets which failed and succeeded.
+    def _compile_tolerant(self, latex_codes, header, fmt_name=None):
+        pages = [None] * len(latex_codes)
+        errors = [None] * len(latex_codes)
+        # (snippets, whether to trust the error line, the suspect split off)
+        pending = [(list(range(len(latex_codes))), True, None)]
+        while pending:
+            indices, use_line, suspect = pending.pop()
+            if suspect is not None and pages[suspect] is not None:
+                # the error line pointed at a snippet which compiles on its
+                # own (e.g. an error reported at \end{document}), bisect
+                use_line = False
+            try:
+                result = self._compile_snippets([latex_codes[i] for i in indices], header, fmt_name)
+            except LatexError as err:
+                if err.in_header:
+                    # the preamble is broken, no snippet can be rendered
+                    log_error("Latex error in the preamble: " + err.message)
+                    raise
+                if len(indices) == 1:
+                    errors[indices[0]] = err.message
+                elif use_line and err.page is not None and err.page < len(indices):
+                    suspect = indices[err.page]
+                    pending.append(([i for i in indices if i != suspect], True, suspect))
+                    pending.append(([suspect], True, None))
+                else:
+                    half = len(indices) // 2
+                    pending.append((indices[half:], use_line, None))
+                    pending.append((indices[:half], use_line, None))
+                continue
+            for i, page in zip(indices, result):
+                pages[i] = page
+        return pages, errors
+
+    # compile snippets in one document and return one SVG group element each
+    def _compile_snippets(self, latex_codes, header, fmt_name=None):
+        pages = self._compile(header, self.tex_body(latex_codes), fmt_name)
+        if len(pages) != len(latex_codes):
+            # a snippet did not produce exactly one page (e.g. it contains a
+            # page break), fall back to compiling each snippet on its own
+            if len(latex_codes) == 1:
+                raise LatexError("%s produced %d pages instead of one" % (self.engine, len(pages)))
+            log_debug("Page count mismatch, rendering snippets one by one")
+            pages = [self._compile_snippets([latex_code], header, fmt_name)[0]
+                     for latex_code in latex_codes]
+        return pages
+
+    # compile a Latex document and return one SVG group element per page,
+    # with a precompiled format only the body has to be compiled
+    def _compile(self, header, body, fmt_name=None):
+
+        # Convert TeX to PDF or DVI, every compile uses its own workspace and the
+        # current working directory is never changed
         tmp_path = tempfile.mkdtemp()
+        try:
+            return self._compile_in(tmp_path, header, body, fmt_name)
+        finally:
+            # delete temp directory, also after a process was killed
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _compile_in(self, tmp_path, header, body, fmt_name=None):
+
+        # Options pass to LaTeX-related commands
+        latexOpts = ['-interaction=nonstopmode',
+                     '-halt-on-error',
+                     '-output-directory=' + tmp_path]
+
+        env = None
+        if fmt_name is not None:
+            latexOpts.append('-fmt=' + fmt_name)
+            env = self._format_env()
+            texwrapper = body
+        else:
+            texwrapper = header + body
+
         texfile_path = os.path.join(tmp_path, 'tmp.tex')
-        # Write tex
-        old_cwd = os.getcwd()
-        os.chdir(tmp_path)
+        with profile_span("write tex"):
+            self._write_tex(texfile_path, texwrapper)
+
+        # Exec pdflatex: tex -> pdf or latex: tex -> dvi
+        output_path = os.path.join(tmp_path, 'tmp.' + self.output_format)
+        cmd = [latex_command(self.engine)] + latexOpts + [texfile_path]
+        cmdlog = self._exec_command(cmd, ok_return_value=None, env=env)
+        message, line = parse_latex_error(cmdlog.decode('utf-8', 'replace'))
+        if message is not None:
+            log_debug(cmdlog)
+            raise self._latex_error(texwrapper, message, line)
+
+        if not os.path.exists(output_path):
+            log_error(self.engine + " didn't produce output ", output_path)
+            # TODO: cleanup excpetion handling and excception chains
+            raise RuntimeError()
+
+        # Convert all pages to SVG files tmp-1.svg, tmp-2.svg, ...
+        if self.backend == "dvisvgm":
+            # glyphs are written as path definitions referenced by <use>
+            # elements, like the output of pdf2svg
+            self._exec_command([self._converter_command(), '--page=1-', '--no-fonts', '--bbox=preview',
+                                '--output=' + os.path.join(tmp_path, 'tmp-%p.svg'), output_path])
+        else:
+            self._exec_command([self._converter_command(), output_path, os.path.join(tmp_path, 'tmp-%d.svg'), 'all'])
+
+        with profile_span("parse pages"):
+            return self._read_pages(tmp_path, self._preview_metrics(tmp_path, cmdlog))
+
+    # the width, height and depth in pt of every snippet (by page number) as
+    # reported by the preview package
+    def _preview_metrics(self, tmp_path, cmdlog):
+        log_path = os.path.join(tmp_path, 'tmp.log')
+        if os.path.exists(log_path):
+            with open(log_path, 'rb') as f:
+                cmdlog = f.read()
+        metrics = {}
+        for match in re.finditer(r"Preview: Snippet ([0-9]+) ended\.\((-?[0-9]+)\+(-?[0-9]+)x(-?[0-9]+)\)",
+                                 cmdlog.decode('utf-8', 'replace')):
+            height, depth, width = [int(v) / 65536.0 for v in match.group(2, 3, 4)]
+            metrics[int(match.group(1))] = (width, height, depth)
+        return metrics
+
+    # map the line of an error to the page of the document it belongs to
+    def _latex_error(self, texwrapper, message, line):
+        if line is None:
+            return LatexError(message)
+        lines = texwrapper.split('\n')[:line]
+        if '\\begin{document}' not in lines:
+            return LatexError(message, in_header=True)
+        body = lines[lines.index('\\begin{document}'):]
+        pages = len([l for l in body if l.startswith('\\begin{preview}')])
+        return LatexError(message, page=max(0, pages - 1))
+
+    def _write_tex(self, texfile_path, texwrapper):
         f_tex = open(texfile_path, 'w')
         try:
             f_tex.write(texwrapper)
         finally:
             f_tex.close()
 
-        # Exec pdflatex: tex -> pdf
-        if PLATFORM == MAC:
-            LATEX_PATH = '/Library/TeX/texbin'
-        else:
-            LATEX_PATH = ''
+    # parse the converted pages tmp-1.svg, tmp-2.svg, ... into SVG groups
+    def _read_pages(self, tmp_path, metrics=None):
+        page_files = []
+        for name in os.listdir(tmp_path):
+            match = re.match(r"^tmp-([0-9]+)\.svg$", name)
+            if match:
+                page_files.append((int(match.group(1)), os.path.join(tmp_path, name)))
 
-        cmdlog = ""
-        try:
-            cmd = [os.path.join(LATEX_PATH, 'pdflatex'), texfile_path] + latexOpts
-            cmdlog = self._exec_command(cmd)
-        except RuntimeError as error:
-            # TODO: cleanup excpetion handling and excception chains
-            log_error(cmdlog)
-            raise RuntimeError()
+        pages = []
+        for page, page_path in sorted(page_files):
+            tree = etree.parse(page_path)
+            root = tree.getroot()
 
-        if not os.path.exists(os.path.join(tmp_path, 'tmp.pdf')):
-            log_error("pdflatex didn't produce output ", os.path.join(tmp_path, 'tmp.pdf'))
-            # TODO: cleanup excpetion handling and excception chains
-            raise RuntimeError()
+            rendergroup = etree.Element('g', nsmap={'rendltx': RENDLTX_NS})
+            for e in root.getchildren():
+                rendergroup.append(e)
 
-        # Convert PDF to SVG
-        if PLATFORM == WINDOWS:
-            PDF2SVG_PATH = os.path.join(os.path.realpath(EXT_PATH), 'pdf2svg')
-        else:
-            PDF2SVG_PATH = ''
-        self._exec_command([os.path.join(PDF2SVG_PATH, 'pdf2svg'), os.path.join(tmp_path, 'tmp.pdf'), os.path.join(tmp_path, 'tmp.svg'), '1'])
+            page_box = None
+            try:
+                page_box = tuple(float(v) for v in root.get('viewBox', "").replace(',', ' ').split())
+            except ValueError:
+                pass
+            if not page_box or len(page_box) != 4:
+                page_box = None
 
-        tree = etree.parse(os.path.join(tmp_path, 'tmp.svg'))
-        root = tree.getroot()
+            # the page starts at the top left corner of the snippet's box
+            if metrics and page in metrics:
+                width, height, depth = metrics[page]
+                origin = page_box[:2] if page_box else (0.0, 0.0)
+                precision = self.compactor.precision
+                rendergroup.attrib['{%s}baseline' % RENDLTX_NS] = "%s %s" % (
+                    format_number(origin[0], precision), format_number(origin[1] + height, precision))
+                for name, value in (('width', width), ('height', height), ('depth', depth)):
+                    rendergroup.attrib['{%s}%s' % (RENDLTX_NS, name)] = format_number(value, precision)
 
-        rendergroup = etree.Element('g')
-        for e in root.getchildren():
-            rendergroup.append(e)
+            with profile_span("compact"):
+                self.compactor.compact(rendergroup, page_box)
+            pages.append(rendergroup)
 
-        os.chdir(old_cwd)
-        shutil.rmtree(tmp_path)  # delete temp directory
-        return rendergroup
+        return pages
+
+
+######################
+# Render daemon
+#    Long running local service which keeps the render cache in memory and
+#    serves the requests of Latex2SvgRenderer over a Unix domain socket. It
+#    shuts down after being idle for a given time.
+class RenderDaemon:
+
+    def __init__(self, cache_dir=None, cache_size=CACHE_SIZE, timeout=DAEMON_TIMEOUT):
+        self.cache = RenderCache(cache_dir, cache_size, memory_entries=DAEMON_MEMORY_ENTRIES)
+        self.socket_path = self.socket_path_for(self.cache.cache_dir)
+        self.timeout = timeout
+        self.started = time.time()
+        self.last_request = self.started
+        self.requests = 0
+        self.running = False
+
+    @staticmethod
+    def available():
+        return hasattr(socket, 'AF_UNIX')
+
+    @staticmethod
+    def socket_path_for(cache_dir=None):
+        cache_dir = cache_dir or RenderCache.default_dir()
+        path = os.path.join(cache_dir, 'daemon.sock')
+        if len(path) > 100:
+            # socket paths are limited to about 100 characters
+            digest = hashlib.sha1(cache_dir.encode('utf-8')).hexdigest()[:12]
+            path = os.path.join(tempfile.gettempdir(), 'latextext-%s.sock' % digest)
+        return path
+
+    # send a request to a daemon and return its reply
+    @staticmethod
+    def request(socket_path, message, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(message).encode('utf-8') + b"\n")
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            sock.close()
+        return json.loads(data.decode('utf-8'))
+
+    def handle(self, message):
+        self.requests += 1
+        self.last_request = time.time()
+        cmd = message.get('cmd')
+        if cmd == 'render':
+            lat2svg = Latex2SvgRenderer(self.cache, message.get('jobs', 1), message.get('use_format', True),
+                                        cwd=message.get('cwd'), backend=message.get('backend', "pdf2svg"),
+                                        precision=message.get('precision', PRECISION),
+                                        bake_transforms=message.get('bake_transforms', False),
+                                        timeout=message.get('timeout', PROCESS_TIMEOUT))
+            try:
+                rendergroups = lat2svg.render_batch(message['latex_codes'], message.get('preamble_file'),
+                                                    message.get('package_list', ""), message.get('fontsize', 10))
+            except RuntimeError:
+                return {'ok': False, 'error': "rendering failed"}
+            return {'ok': True,
+                    'groups': [etree.tostring(group).decode('utf-8') if group is not None else None
+                               for group in rendergroups],
+                    'errors': dict((str(i), error) for i, error in lat2svg.errors.items())}
+        elif cmd == 'status':
+            return {'ok': True, 'pid': os.getpid(), 'uptime': time.time() - self.started,
+                    'requests': self.requests, 'cache_hits': self.cache.hits,
+                    'cache_misses': self.cache.misses, 'timeout': self.timeout}
+        elif cmd == 'stop':
+            self.running = False
+            return {'ok': True}
+        return {'ok': False, 'error': "unknown command %s" % cmd}
+
+    def serve(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    message = json.loads(self.rfile.readline().decode('utf-8'))
+                    reply = daemon.handle(message)
+                except Exception as err:
+                    reply = {'ok': False, 'error': str(err)}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b"\n")
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = Server(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o600)
+        server.timeout = 1
+        self.running = True
+        try:
+            while self.running and time.time() - self.last_request < self.timeout:
+                server.handle_request()
+        finally:
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    # start a daemon in the background and wait until it accepts requests
+    @staticmethod
+    def start(cache_dir=None, cache_size=CACHE_SIZE, timeout=DAEMON_TIMEOUT):
+        socket_path = RenderDaemon.socket_path_for(cache_dir)
+        if RenderDaemon.status(cache_dir) is not None:
+            return True
+        try:
+            os.makedirs(os.path.dirname(socket_path))
+        except OSError:
+            pass
+        cmd = [sys.executable, os.path.abspath(__file__), '--daemon', 'run',
+               '--cache-size', str(cache_size), '--daemon-timeout', str(timeout)]
+        if cache_dir:
+            cmd += ['--cache-dir', cache_dir]
+        devnull = open(os.devnull, 'w')
+        subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+        for i in range(50):
+            time.sleep(0.1)
+            if RenderDaemon.status(cache_dir) is not None:
+                return True
+        return False
+
+    @staticmethod
+    def stop(cache_dir=None):
+        socket_path = RenderDaemon.socket_path_for(cache_dir)
+        try:
+            RenderDaemon.request(socket_path, {'cmd': 'stop'}, timeout=5)
+        except (socket.error, ValueError):
+            return False
+        # the socket is removed once the daemon has shut down
+        for i in range(50):
+            if not os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        return True
+
+    # return the status of a running daemon or None
+    @staticmethod
+    def status(cache_dir=None):
+        try:
+            return RenderDaemon.request(RenderDaemon.socket_path_for(cache_dir), {'cmd': 'status'}, timeout=5)
+        except (socket.error, ValueError):
+            return None
 
 
 ######################
@@ -628,7 +2420,268 @@ def add_options(parser):
                       help="encapsulate all text in math mode")
     parser.add_option("-c", "--clean",
                       action="store_true", dest="clean",
-                      help="remove all renderings")
+                      help="remove all renderings, or those of the selected text elements")
+    parser.add_option("--select", dest="select",
+                      help="only render the text elements matching an XPath expression (prefix svg:)",
+                      metavar="XPATH")
+    parser.add_option("-b", "--backend", dest="backend", type="choice",
+                      choices=sorted(BACKENDS.keys()), default="pdf2svg",
+                      help="render with pdflatex and pdf2svg or with latex and dvisvgm (default: %default)")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of parallel Latex processes (default: %default)")
+    parser.add_option("--no-format", dest="no_format",
+                      action="store_true", default=False,
+                      help="do not precompile the preamble into a Latex format")
+    parser.add_option("--timeout", dest="timeout", type="float", default=PROCESS_TIMEOUT,
+                      help="seconds until a Latex or converter process is killed, 0 for no limit (default: %default)")
+    parser.add_option("--precision", dest="precision", type="int", default=PRECISION,
+                      help="number of decimals of the coordinates in renderings (default: %default)")
+    parser.add_option("--bake-transforms", dest="bake_transforms",
+                      action="store_true", default=False,
+                      help="move translations of rendered elements into their coordinates")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="directory of the render cache", metavar="DIR")
+    parser.add_option("--cache-size", dest="cache_size", type="int", default=CACHE_SIZE,
+                      help="maximum size of the render cache in MB (default: %default)")
+    parser.add_option("--profile", dest="profile",
+                      help="write a trace of the time spent in every stage (Chrome trace format)", metavar="FILE")
+
+
+# expand wildcards and directories (recursively) in a list of input paths,
+# returns a list of (input file, path relative to the output directory).
+# Files and directories in exclude, e.g. the output directory, are skipped
+# while expanding.
+def collect_input_files(paths, exclude=()):
+    exclude = set(os.path.abspath(path) for path in exclude)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(name for name in dirnames
+                                     if os.path.abspath(os.path.join(dirpath, name)) not in exclude)
+                for name in sorted(filenames):
+                    if name.lower().endswith(('.svg', '.svgz')):
+                        infile = os.path.join(dirpath, name)
+                        if os.path.abspath(infile) not in exclude:
+                            files.append((infile, os.path.relpath(infile, path)))
+        elif '*' in path or '?' in path:
+            files.extend((infile, os.path.basename(infile)) for infile in sorted(glob.glob(path))
+                         if os.path.abspath(infile) not in exclude)
+        else:
+            files.append((path, os.path.basename(path)))
+    return files
+
+
+# the error of process_file if the input changed while it was rendered
+INPUT_CHANGED = "input changed while rendering"
+
+
+# modification state of a file, None if it does not exist
+def file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+# render a single file, returns the time it took, an error message or None
+# if the file could not be rendered at all, and the (id, error message) of
+# the text elements which failed. If the file_state of the input when it was
+# read is given, nothing is written if the input changed in the meantime.
+def process_file(infile, outfile, options, cache=None, input_state=None):
+    start = time.time()
+    log_info("Rendering", infile, "->", outfile)
+    failures = []
+    try:
+        # options are updated with the parameters stored in the document,
+        # so every file gets its own copy
+        with profile_span("load", file=infile):
+            svgprocessor = SvgProcessor(infile, copy.copy(options), cache)
+
+        # skip documents which are up to date. A document rendered in place
+        # stores the fingerprint it has after the run, one rendered into
+        # another file stores the fingerprint of its input, which includes
+        # the contents of the input file.
+        fingerprint = None
+        if not (options.clean or options.ids or options.select):
+            in_place = os.path.abspath(infile) == os.path.abspath(outfile)
+            with profile_span("fingerprint", file=infile):
+                stored = None
+                if in_place:
+                    fingerprint = svgprocessor.fingerprint()
+                    stored = stored_fingerprint(svgprocessor.docroot)
+                else:
+                    fingerprint = svgprocessor.fingerprint(files_digest([infile]))
+                    try:
+                        stored = stored_fingerprint(parse_document(outfile).getroot())
+                    except (IOError, OSError, etree.XMLSyntaxError):
+                        pass
+            if stored == fingerprint:
+                log_info(outfile, "is up to date")
+                return time.time() - start, None, failures
+
+        with profile_span("run", file=infile):
+            result = svgprocessor.run()
+        if fingerprint is not None:
+            # a failed or cancelled text element is tried again next time
+            if svgprocessor.failures or svgprocessor.cancelled:
+                fingerprint = None
+            elif in_place:
+                fingerprint = svgprocessor.fingerprint()
+            svgprocessor.store_fingerprint(fingerprint)
+
+        if options.clean:
+            print("%s: %d renderings %s, %d bytes %s" % (
+                infile, svgprocessor.removed_count, "would be removed" if options.dry_run else "removed",
+                svgprocessor.reclaimed_bytes, "would be reclaimed" if options.dry_run else "reclaimed"))
+
+        # write processed XML to a file
+        if not options.dry_run:
+            if input_state is not None and file_state(infile) != input_state:
+                return time.time() - start, INPUT_CHANGED, failures
+            out_dir = os.path.dirname(outfile)
+            if out_dir and not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            with profile_span("write", file=outfile):
+                write_document(result, outfile, not options.no_pretty)
+        failures = svgprocessor.failures
+    except RuntimeError:
+        return time.time() - start, "rendering failed", failures
+    except (IOError, OSError, etree.XMLSyntaxError) as err:
+        return time.time() - start, str(err), failures
+    return time.time() - start, None, failures
+
+
+def _make_escape(path):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+# write the input file and the preamble files every output depends on as a
+# make style dependency file, which Make and Ninja can include. A file
+# rendered in place only depends on its preamble files.
+def write_depfile(path, jobs, preamble=None):
+    with open(path, 'w') as f:
+        for infile, outfile in jobs:
+            deps = document_dependencies(outfile if os.path.exists(outfile) else infile, preamble)
+            if os.path.abspath(infile) != os.path.abspath(outfile):
+                deps = [infile] + deps
+            f.write(" ".join([_make_escape(outfile) + ":"] + [_make_escape(dep) for dep in deps]) + "\n")
+
+
+# write the errors of a commandline run as JSON
+def write_error_report(path, jobs, results):
+    files = []
+    for (infile, outfile), (seconds, error, failures) in zip(jobs, results):
+        files.append({'input': infile, 'output': outfile, 'seconds': round(seconds, 3), 'error': error,
+                      'failures': [{'id': node_id, 'error': message} for node_id, message in failures]})
+    report = {'files': files,
+              'failed_files': len([f for f in files if f['error']]),
+              'failed_elements': sum(len(f['failures']) for f in files)}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+######################
+# Watch mode
+#    Monitor SVG files and the preamble files they use and re-render the
+#    files which changed. Files written by the watcher itself are ignored.
+class SvgWatcher:
+
+    def __init__(self, paths, options, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+        self.paths = paths
+        self.options = options
+        self.interval = interval
+        self.debounce = debounce
+        self.cache = RenderCache(options.cache_dir, options.cache_size)
+        self.outfiles = {}
+        self.dependencies = {}
+        self.inotify = INotify() if INOTIFY_AVAILABLE else None
+        self.inotify_watches = {}
+        self._watched = []
+
+    # modification state of all watched SVG files and their dependencies
+    def _scan(self):
+        state = {}
+        # the files written by the watcher are no input
+        exclude = [outfile for infile, outfile in self.outfiles.items() if outfile != infile]
+        if self.options.outfile and os.path.isdir(self.options.outfile):
+            exclude.append(self.options.outfile)
+        for infile, relpath in collect_input_files(self.paths, exclude):
+            if infile not in self.outfiles:
+                if self.options.outfile and os.path.isdir(self.options.outfile):
+                    self.outfiles[infile] = os.path.join(self.options.outfile, relpath)
+                else:
+                    self.outfiles[infile] = infile
+                self.dependencies[infile] = document_dependencies(infile, self.options.preamble)
+            state[infile] = file_state(infile)
+        for deps in self.dependencies.values():
+            for path in deps:
+                state[path] = file_state(path)
+        return state
+
+    # block until something may have changed
+    def _wait(self):
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return
+        dirs = set(os.path.dirname(os.path.abspath(path)) for path in self._watched)
+        for path in dirs - set(self.inotify_watches):
+            mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE | inotify_flags.DELETE
+            try:
+                self.inotify_watches[path] = self.inotify.add_watch(path, mask)
+            except OSError:
+                pass
+        # time out now and then to catch changes in new directories
+        self.inotify.read(timeout=1000)
+
+    def run(self):
+        state = self._scan()
+        log_info("Watching %d files, press Ctrl+C to stop" % len(self.outfiles))
+
+        while True:
+            self._watched = list(state)
+            self._wait()
+            new_state = self._scan()
+            if new_state == state:
+                continue
+
+            # wait until a burst of writes is over
+            while True:
+                time.sleep(self.debounce)
+                settled_state = self._scan()
+                if settled_state == new_state:
+                    break
+                new_state = settled_state
+
+            # files are compared against the state they were rendered from,
+            # so changes saved while rendering are picked up next time
+            changed = set(path for path in new_state if new_state[path] != state.get(path))
+            state = new_state
+            for infile in sorted(self.outfiles):
+                if infile not in new_state:
+                    continue
+                if infile not in changed and not changed.intersection(self.dependencies.get(infile, [])):
+                    continue
+                outfile = self.outfiles[infile]
+                seconds, error, failures = process_file(infile, outfile, self.options, self.cache,
+                                                        input_state=new_state[infile])
+                if error == INPUT_CHANGED:
+                    log_info(infile, "changed while rendering, rendering again")
+                    continue
+                if error:
+                    log_error("ERROR while rendering " + infile + ": " + error)
+                elif failures:
+                    print("%s rendered in %.2f s, %d text elements failed" % (infile, seconds, len(failures)))
+                else:
+                    print("%s rendered in %.2f s" % (infile, seconds))
+                # the output written above is not a change
+                if outfile in state:
+                    state[outfile] = file_state(outfile)
+                self.dependencies[infile] = document_dependencies(outfile, self.options.preamble)
+                for path in self.dependencies[infile]:
+                    if path not in state:
+                        state[path] = file_state(path)
 
 
 if STANDALONE is False:
@@ -651,8 +2704,14 @@ if STANDALONE is False:
         def effect(self):
             if self.options.debug is True:
                 set_log_level(log_level_debug)
-            svgprocessor = SvgProcessor(self.document, self.options)
-            svgprocessor.run()
+            if self.options.profile:
+                set_profiler(Profiler())
+            try:
+                svgprocessor = SvgProcessor(self.document, self.options)
+                svgprocessor.run()
+            finally:
+                if PROFILER is not None:
+                    PROFILER.write(self.options.profile)
 else:
     # Create a standalone commandline application
     def main_standalone():
@@ -662,46 +2721,155 @@ else:
         add_options(parser)
         parser.add_option("-v", "--verbose", default=False,
                           action="store_true", dest="verbose")
+        parser.add_option("--id", action="append", dest="ids", default=[],
+                          help="only render the text element or group with this id, can be given several times",
+                          metavar="ID")
+        parser.add_option("--dry-run", default=False,
+                          action="store_true", dest="dry_run",
+                          help="do not write any file, e.g. to see what --clean would remove")
+        parser.add_option("--depfile", dest="depfile",
+                          help="write the files every output depends on as a Make/Ninja dependency file",
+                          metavar="FILE")
+        parser.add_option("--error-report", dest="error_report",
+                          help="write the files and text elements which failed to render as JSON", metavar="FILE")
+        parser.add_option("--fail-on-error", default=False,
+                          action="store_true", dest="fail_on_error",
+                          help="exit with status 1 if a file or text element failed to render")
+        parser.add_option("--no-pretty", default=False,
+                          action="store_true", dest="no_pretty",
+                          help="write the output without indentation")
+        parser.add_option("-w", "--watch", default=False,
+                          action="store_true", dest="watch",
+                          help="watch the given files and directories and render them whenever they change")
+        parser.add_option("--cache-stats", default=False,
+                          action="store_true", dest="cache_stats",
+                          help="print statistics of the render cache")
+        parser.add_option("--cache-prune", default=False,
+                          action="store_true", dest="cache_prune",
+                          help="evict old entries until the render cache fits into --cache-size")
+        parser.add_option("--daemon", dest="daemon", type="choice",
+                          choices=["start", "stop", "status", "run"],
+                          help="start, stop or query the render daemon", metavar="CMD")
+        parser.add_option("--daemon-timeout", dest="daemon_timeout", type="int", default=DAEMON_TIMEOUT,
+                          help="seconds until an idle render daemon shuts down (default: %default)")
         (options, args) = parser.parse_args()
 
         if options.verbose is True:
             set_log_level(log_level_debug)
+        if options.profile:
+            set_profiler(Profiler())
 
-        # expand wildcards
-        args = [glob.glob(arg) if '*' in arg else arg for arg in args]
+        if options.daemon:
+            if not RenderDaemon.available():
+                log_error("The render daemon is not supported on this platform.")
+                sys.exit(1)
+            if options.daemon == "run":
+                RenderDaemon(options.cache_dir, options.cache_size, options.daemon_timeout).serve()
+            elif options.daemon == "start":
+                if not RenderDaemon.start(options.cache_dir, options.cache_size, options.daemon_timeout):
+                    log_error("Could not start the render daemon.")
+                    sys.exit(1)
+            elif options.daemon == "stop":
+                RenderDaemon.stop(options.cache_dir)
+            status = RenderDaemon.status(options.cache_dir)
+            if status is None:
+                print("Render daemon is not running")
+            else:
+                print("Render daemon is running (pid %d, %d requests, idle timeout %d s)"
+                      % (status['pid'], status['requests'], status['timeout']))
+            if not args:
+                sys.exit(0 if status is not None or options.daemon != "status" else 1)
+
+        if options.cache_stats or options.cache_prune:
+            cache = RenderCache(options.cache_dir, options.cache_size)
+            if options.cache_prune:
+                removed = cache.prune()
+                print("Removed %d cache entries" % removed)
+            if options.cache_stats:
+                stats = cache.stats()
+                print("Cache location: %s" % stats.location)
+                print("Entries:        %d" % stats.entries)
+                print("Formats:        %d" % stats.formats)
+                print("Size:           %.1f of %.1f MB" % (stats.size / 1048576.0, stats.max_size / 1048576.0))
+            if not args:
+                sys.exit(0)
+
+        if options.watch:
+            if not args:
+                log_error('No file or directory to watch specified!')
+                sys.exit(1)
+            try:
+                SvgWatcher(args, options).run()
+            except KeyboardInterrupt:
+                pass
+            if PROFILER is not None:
+                PROFILER.write(options.profile)
+            sys.exit(0)
+
+        # expand wildcards and directories, leaving out the output directory
+        # if it is inside of them
+        if options.outfile and os.path.isdir(options.outfile):
+            files = collect_input_files(args, [options.outfile])
+        else:
+            files = collect_input_files(args)
 
-        if len(args) < 1:
+        if len(files) < 1:
             log_error('No input file specified! Call with -h argument for usage instructions.')
             sys.exit(1)
-        elif len(args) > 2 and options.outfile and not os.path.isdir(options.outfile):
+        elif len(files) > 1 and options.outfile and not os.path.isdir(options.outfile):
             log_error('If more than one input file is specified -o/--outfile has to point to a directory.')
             sys.exit(1)
 
-        # main loop, run the SVG processor for each input file
-        for infile in args:
+        jobs = []
+        for infile, relpath in files:
             if options.outfile:
                 if os.path.isdir(options.outfile):
-                    outfile = os.path.join(options.outfile, os.path.basename(infile))
+                    outfile = os.path.join(options.outfile, relpath)
                 else:
                     outfile = options.outfile
             else:
                 outfile = infile
+            jobs.append((infile, outfile))
 
-            log_info("Rendering " + infile + " -> " + outfile)
+        # with several files, the workers process whole files and share
+        # the parallel Latex processes among them
+        workers = max(1, min(options.jobs, len(jobs)))
+        options.jobs = max(1, options.jobs // workers)
+        cache = RenderCache(options.cache_dir, options.cache_size)
 
-            svgprocessor = SvgProcessor(infile, options)
+        def process_job(job):
+            return process_file(job[0], job[1], options, cache)
 
+        if workers > 1:
+            pool = ThreadPool(workers)
             try:
-                result = svgprocessor.run()
-            except RuntimeError:
-                log_error("ERROR while rendering " + infile)
-                sys.exit(1)
-
-            # write processed XML to a file
-            xmlstr = etree.tostring(result, pretty_print=True, xml_declaration=True)
-            f = open(outfile, 'w')
-            f.write(xmlstr.decode('utf-8'))
-            f.close()
+                results = pool.map(process_job, jobs)
+            finally:
+                pool.close()
+        else:
+            results = [process_job(job) for job in jobs]
+
+        failed_files = [infile for (infile, outfile), (seconds, error, failures) in zip(jobs, results) if error]
+        failed_count = sum(len(failures) for seconds, error, failures in results)
+        for (infile, outfile), (seconds, error, failures) in zip(jobs, results):
+            if error:
+                log_error("ERROR while rendering " + infile + ": " + error)
+
+        if len(jobs) > 1:
+            print("\nSummary:")
+            for (infile, outfile), (seconds, error, failures) in zip(jobs, results):
+                status = "FAILED" if error else ("%d err" % len(failures) if failures else "ok")
+                print("  %8.2f s  %-7s %s" % (seconds, status, infile))
+            print("%d files rendered, %d failed, %d failed text elements, %.2f s total"
+                  % (len(jobs) - len(failed_files), len(failed_files), failed_count, sum(r[0] for r in results)))
+        if options.error_report:
+            write_error_report(options.error_report, jobs, results)
+        if options.depfile:
+            write_depfile(options.depfile, jobs, options.preamble)
+        if PROFILER is not None:
+            PROFILER.write(options.profile)
+        if options.fail_on_error and (failed_files or failed_count):
+            sys.exit(1)
 
 
 if __name__ == "__main__":
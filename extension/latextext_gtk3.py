@@ -5,7 +5,8 @@
 try:
     import gi
     gi.require_version('Gtk', '3.0')
-    from gi.repository import Gtk, Gdk
+    gi.require_version('GdkPixbuf', '2.0')
+    from gi.repository import Gtk, Gdk, GLib, GdkPixbuf
     GTK3_AVAILABLE = True
 except ImportError:
     GTK3_AVAILABLE = False
@@ -20,7 +21,22 @@ except ImportError:
     print("GTK3 variant has to be run as an Inkscape extension!")
     raise
 
-from latextext import RenderLatexEffect, SvgProcessor, set_log_level, log_level_debug
+import copy
+import time
+import threading
+from lxml import etree
+
+from latextext import RenderLatexEffect, SvgProcessor, LatexError, RenderCancelled, set_log_level, log_level_debug
+
+# milliseconds without further changes of the settings before the preview
+# is rendered again
+PREVIEW_DELAY = 400
+
+
+# format a duration in seconds as m:ss
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d" % (seconds // 60, seconds % 60)
 
 
 ######################
@@ -29,8 +45,16 @@ from latextext import RenderLatexEffect, SvgProcessor, set_log_level, log_level_
 #    default interface
 class Gtk3ParamGui(Gtk.Window):
 
-    def __init__(self, run_callback):
-        self.run_callback = run_callback
+    def __init__(self, svgprocessor):
+        self.svgprocessor = svgprocessor
+        self.worker = None
+        self.error = None
+        # the preview is rendered by one worker at a time, results of
+        # settings which changed in the meantime are dropped
+        self.preview_worker = None
+        self.preview_renderer = None
+        self.preview_timer = None
+        self.preview_generation = 0
         Gtk.Window.__init__(self, title="LaTexText (GTK3)")
         gh = Gdk.Geometry()
         gh.max_height = 120
@@ -108,17 +132,70 @@ class Gtk3ParamGui(Gtk.Window):
         self.btnShowLog = Gtk.CheckButton()
         grid.attach(self.btnShowLog, 1, row_count, 1, 1)
 
-        row_count += 2
+        row_count += 1
+        grid.attach(Gtk.Label("Preview"), 0, row_count, 1, 1)
+        self.previewTexts = [txt for txt, ctm in self.svgprocessor.iter_text_nodes()
+                             if self.svgprocessor.latex_source(txt) is not None]
+        self.comboPreview = Gtk.ComboBoxText()
+        for txt in self.previewTexts:
+            source = self.svgprocessor.latex_source(txt).strip().replace('\n', ' ')
+            if len(source) > 40:
+                source = source[:40] + "..."
+            self.comboPreview.append_text("%s: %s" % (txt.get('id'), source))
+        if self.previewTexts:
+            self.comboPreview.set_active(0)
+        grid.attach(self.comboPreview, 1, row_count, 1, 1)
+
+        row_count += 1
+        previewFrame = Gtk.Frame()
+        previewBox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=3)
+        previewBox.set_border_width(6)
+        self.imagePreview = Gtk.Image()
+        self.imagePreview.set_size_request(-1, 60)
+        previewBox.pack_start(self.imagePreview, True, True, 0)
+        self.labelPreview = Gtk.Label()
+        self.labelPreview.set_line_wrap(True)
+        previewBox.pack_start(self.labelPreview, False, False, 0)
+        previewFrame.add(previewBox)
+        grid.attach(previewFrame, 0, row_count, 2, 1)
+
+        row_count += 1
+        self.progressBar = Gtk.ProgressBar()
+        self.progressBar.set_show_text(True)
+        self.progressBar.set_no_show_all(True)
+        grid.attach(self.progressBar, 0, row_count, 2, 1)
+
+        row_count += 1
         box1 = Gtk.Box(spacing=6)
         grid.attach(box1, 0, row_count, 2, 1)
 
         btnApply = Gtk.Button(label="Apply")
         btnApply.connect("clicked", self.on_btnApply_clicked)
         box1.pack_end(btnApply, False, False, 0)
+        self.btnApply = btnApply
 
         btnClose = Gtk.Button(label="Close")
         btnClose.connect("clicked", self.on_btnClose_clicked)
         box1.pack_end(btnClose, False, False, 0)
+        self.btnClose = btnClose
+
+        self.btnCancel = Gtk.Button(label="Cancel")
+        self.btnCancel.connect("clicked", self.on_btnCancel_clicked)
+        self.btnCancel.set_no_show_all(True)
+        box1.pack_end(self.btnCancel, False, False, 0)
+
+        self.grid = grid
+        self.buttonBox = box1
+
+        # render the preview again whenever a setting changes
+        for entry in (self.entryPreamble, self.entryPackages):
+            entry.connect("changed", self.on_settings_changed)
+        for spin in (self.entryFontsize, self.entryScale):
+            spin.connect("value-changed", self.on_settings_changed)
+        for check in (self.btnNewline, self.btnMath):
+            check.connect("toggled", self.on_settings_changed)
+        self.comboPreview.connect("changed", self.on_settings_changed)
+        self.on_settings_changed(None)
 
         self.show_all()
         self.entryScale.grab_focus()
@@ -143,21 +220,156 @@ class Gtk3ParamGui(Gtk.Window):
     def on_btnClose_clicked(self, widget):
         Gtk.main_quit()
 
+    # closing the window while rendering cancels the rendering, the dialog
+    # quits as soon as the worker has stopped
+    def on_delete_event(self, widget, event):
+        if self.worker is not None:
+            self.on_btnCancel_clicked(widget)
+            return True
+        Gtk.main_quit()
+        return False
+
+    def on_btnCancel_clicked(self, widget):
+        self.btnCancel.set_sensitive(False)
+        self.btnCancel.set_label("Cancelling...")
+        self.svgprocessor.cancel()
+
+    # store the settings of the dialog in the given options
+    def read_settings(self, options):
+        options.scale = self.entryScale.get_value()
+        options.depth = self.entryDepth.get_value()
+        options.fontsize = self.entryFontsize.get_value()
+        options.preamble = self.entryPreamble.get_text()
+        options.packages = self.entryPackages.get_text()
+        options.math = self.btnMath.get_active()
+        options.newline = self.btnNewline.get_active()
+        return options
+
+    def on_settings_changed(self, widget):
+        self.preview_generation += 1
+        if self.preview_renderer is not None:
+            # the running preview is outdated, it is started again when it
+            # has stopped
+            self.preview_renderer.cancel()
+        if self.preview_timer is not None:
+            GLib.source_remove(self.preview_timer)
+        self.preview_timer = GLib.timeout_add(PREVIEW_DELAY, self.start_preview)
+
+    def start_preview(self):
+        self.preview_timer = None
+        index = self.comboPreview.get_active()
+        if self.worker is not None or index < 0:
+            return False
+        if self.preview_worker is not None:
+            # started again when the running preview is done
+            return False
+        self.labelPreview.set_text("Rendering...")
+        options = self.read_settings(copy.copy(self.options))
+        self.preview_renderer = self.svgprocessor.renderer(options)
+        self.preview_worker = threading.Thread(target=self.preview_render,
+                                               args=(self.preview_generation, self.previewTexts[index], options,
+                                                     self.preview_renderer))
+        self.preview_worker.daemon = True
+        self.preview_worker.start()
+        return False
+
+    # render the preview in a worker thread, renderings and formats are
+    # taken from the render cache like for a full run
+    def preview_render(self, generation, txt, options, renderer):
+        data = None
+        error = None
+        try:
+            svg = self.svgprocessor.render_preview(txt, options, renderer)
+            if svg is not None:
+                data = etree.tostring(svg)
+        except LatexError as err:
+            error = err.message
+        except RenderCancelled:
+            error = "Cancelled"
+        except RuntimeError:
+            error = "Rendering failed"
+        except Exception as err:
+            error = str(err)
+        GLib.idle_add(self.show_preview, generation, data, error)
+
+    def show_preview(self, generation, data, error):
+        self.preview_worker = None
+        self.preview_renderer = None
+        if generation != self.preview_generation:
+            # the settings changed while rendering
+            if self.preview_timer is None:
+                self.start_preview()
+            return False
+
+        if error is not None:
+            self.imagePreview.clear()
+            self.labelPreview.set_text(error)
+            return False
+        if data is None:
+            self.imagePreview.clear()
+            self.labelPreview.set_text("Empty text element")
+            return False
+        try:
+            loader = GdkPixbuf.PixbufLoader.new_with_type('svg')
+            loader.write(data)
+            loader.close()
+            self.imagePreview.set_from_pixbuf(loader.get_pixbuf())
+            self.labelPreview.set_text("")
+        except GLib.Error as err:
+            self.imagePreview.clear()
+            self.labelPreview.set_text("Cannot show the preview: %s" % err)
+        return False
+
     def on_btnApply_clicked(self, widget):
         # get parameters
-        self.options.scale = self.entryScale.get_value()
-        self.options.depth = self.entryDepth.get_value()
-        self.options.fontsize = self.entryFontsize.get_value()
-        self.options.preamble = self.entryPreamble.get_text()
-        self.options.packages = self.entryPackages.get_text()
-        self.options.math = self.btnMath.get_active()
-        self.options.newline = self.btnNewline.get_active()
+        self.read_settings(self.options)
         if self.btnShowLog.get_active() is True:
             set_log_level(log_level_debug)
+
+        # render in the background, the text elements rendered so far are
+        # kept in the document if the rendering is cancelled
+        for child in self.grid.get_children():
+            if child not in (self.buttonBox, self.progressBar):
+                child.set_sensitive(False)
+        self.btnApply.set_sensitive(False)
+        self.btnClose.set_sensitive(False)
+        if self.preview_timer is not None:
+            GLib.source_remove(self.preview_timer)
+            self.preview_timer = None
+        self.progressBar.set_text("Preparing...")
+        self.progressBar.show()
+        self.btnCancel.show()
+
+        self.started = time.time()
+        self.worker = threading.Thread(target=self.render_worker)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def render_worker(self):
         try:
-            self.run_callback()
+            self.svgprocessor.run(progress=self.on_progress)
+        except Exception as err:
+            self.error = err
         finally:
-            Gtk.main_quit()
+            GLib.idle_add(self.on_render_finished)
+
+    # called from the worker thread, the widgets are only updated in the main loop
+    def on_progress(self, done, total):
+        GLib.idle_add(self.update_progress, done, total)
+
+    def update_progress(self, done, total):
+        elapsed = time.time() - self.started
+        text = "%d/%d text elements, %s elapsed" % (done, total, format_duration(elapsed))
+        if 0 < done < total:
+            text += ", %s remaining" % format_duration(elapsed * (total - done) / done)
+        self.progressBar.set_fraction(float(done) / total if total else 1.0)
+        self.progressBar.set_text(text)
+        return False
+
+    def on_render_finished(self):
+        self.worker = None
+        Gtk.main_quit()
+        return False
 
 
 # Extend standard inkscape extension with the GTK3 GUI
@@ -166,10 +378,12 @@ class RenderLatexEffectGTK3(RenderLatexEffect):
     def effect(self):
         svgprocessor = SvgProcessor(self.document, self.options)
 
-        ParamGui = Gtk3ParamGui(svgprocessor.run)
-        ParamGui.connect("delete-event", Gtk.main_quit)
+        ParamGui = Gtk3ParamGui(svgprocessor)
+        ParamGui.connect("delete-event", ParamGui.on_delete_event)
         ParamGui.prepare_dialog(svgprocessor.options)
         Gtk.main()
+        if ParamGui.error is not None:
+            raise ParamGui.error
 
 
 if __name__ == "__main__":
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the LaTeXText render pipeline.
+
+Usage: benchmark.py [options] BENCHMARK
+
+    format      per-snippet latency with and without a precompiled format
+    backends    compare the pdf2svg and dvisvgm render backends
+    insert      insert and replace renderings of 10, 1k and 10k text nodes
+    pipeline    render a synthetic document and report the time of every
+                stage, optionally with stub Latex tools (--stub), save the
+                results (--save) and compare them to a baseline (--baseline)
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import collections
+from optparse import OptionParser
+
+ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT_PATH, 'extension'))
+
+import latextext
+from lxml import etree
+
+# a small corpus of typical plot labels
+SNIPPETS = [
+    r"$0$", r"$10^3$", r"$\alpha$", r"Time $t$ in s", r"$\sqrt{x^2 + y^2}$",
+    r"$\frac{1}{2}\pi$", r"Frequency $f$ / Hz", r"$\mathbf{x}_k$",
+    r"$\sum_{n=0}^{N-1} x[n]$", r"Magnitude in dB",
+]
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def print_timings(label, timings):
+    timings = sorted(timings)
+    mean = sum(timings) / len(timings)
+    median = timings[len(timings) // 2]
+    print("%-24s mean %8.1f ms   median %8.1f ms   (n=%d)" % (label, mean * 1000, median * 1000, len(timings)))
+
+
+# render every snippet on its own, each one is made unique with a trailing
+# comment so that the render cache never hits
+def bench_format(options):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        results = {}
+        for use_format in (False, True):
+            cache = latextext.RenderCache(cache_dir)
+            renderer = latextext.Latex2SvgRenderer(cache, use_format=use_format)
+            # the first rendering creates the format, exclude it from the timings
+            renderer.render("warmup %% %s" % use_format, options.preamble, options.packages, options.fontsize)
+            timings = []
+            for n in range(options.repeat):
+                for i, snippet in enumerate(SNIPPETS):
+                    code = "%s %% %s-%d-%d" % (snippet, use_format, n, i)
+                    t, _ = timed(renderer.render, code, options.preamble, options.packages, options.fontsize)
+                    timings.append(t)
+            results[use_format] = timings
+        print_timings("without format", results[False])
+        print_timings("with format", results[True])
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+# render the corpus with every backend, once as a single batch and once
+# snippet by snippet, and compare the time and the size of the output
+def bench_backends(options):
+    for backend in sorted(latextext.BACKENDS):
+        timings = []
+        batch_timings = []
+        size = 0
+        for n in range(options.repeat):
+            renderer = latextext.Latex2SvgRenderer(backend=backend, use_format=False)
+            t, groups = timed(renderer.render_batch, SNIPPETS, options.preamble, options.packages, options.fontsize)
+            batch_timings.append(t)
+            size = sum(len(etree.tostring(group)) for group in groups)
+            for snippet in SNIPPETS:
+                t, _ = timed(renderer.render, snippet, options.preamble, options.packages, options.fontsize)
+                timings.append(t)
+        print_timings("%s batch" % backend, batch_timings)
+        print_timings("%s per snippet" % backend, timings)
+        print("%-24s %d bytes for %d snippets" % ("%s output" % backend, size, len(SNIPPETS)))
+
+
+def processor_options(**kwargs):
+    parser = OptionParser()
+    latextext.add_options(parser)
+    options, args = parser.parse_args([])
+    for name, value in kwargs.items():
+        setattr(options, name, value)
+    return options
+
+
+# transforms of increasing complexity for the groups of synthetic documents
+TRANSFORMS = [
+    None,
+    "translate(5,7)",
+    "translate(5 7) scale(1.5)",
+    "matrix(0.9,0.1,-0.1,0.9,3,4) rotate(15 10 10) skewX(5) scale(1.2,0.8)",
+]
+
+
+# a document with the given number of text nodes, each one nested into depth
+# groups with transforms of the given complexity (an index into TRANSFORMS).
+# The given ratio of the texts repeats an earlier label.
+def synthetic_document(count, depth=0, transforms=0, duplicates=0.0, seed=0):
+    rng = random.Random(seed)
+    svg = etree.Element('{%s}svg' % latextext.SVG_NS, nsmap={None: latextext.SVG_NS})
+    svg.attrib['width'] = '210mm'
+    svg.attrib['height'] = '297mm'
+    labels = []
+    for i in range(count):
+        parent = svg
+        for level in range(depth):
+            parent = etree.SubElement(parent, '{%s}g' % latextext.SVG_NS)
+            parent.attrib['id'] = 'g%d-%d' % (i, level)
+            if TRANSFORMS[transforms]:
+                parent.attrib['transform'] = TRANSFORMS[transforms]
+        if labels and rng.random() < duplicates:
+            label = rng.choice(labels)
+        else:
+            label = '$%d$' % i
+            labels.append(label)
+        txt = etree.SubElement(parent, '{%s}text' % latextext.SVG_NS)
+        txt.attrib['id'] = 'text%d' % i
+        txt.attrib['x'] = str(i % 100)
+        txt.attrib['y'] = str(i // 100)
+        if TRANSFORMS[transforms]:
+            txt.attrib['transform'] = TRANSFORMS[transforms]
+        txt.text = label
+    return etree.ElementTree(svg)
+
+
+# a rendering as it comes from pdf2svg, with a few glyphs
+def synthetic_rendering(i):
+    group = etree.Element('g')
+    inner = etree.SubElement(group, '{%s}g' % latextext.SVG_NS)
+    for n in range(4):
+        use = etree.SubElement(inner, '{%s}use' % latextext.SVG_NS)
+        use.attrib['{%s}href' % latextext.XLINK_NS] = '#glyph0-%d' % n
+        use.attrib['x'] = str(n * 5)
+        use.attrib['y'] = '0'
+    return group
+
+
+# time inserting all renderings into an empty render layer and replacing
+# them afterwards, without running Latex
+def bench_insert(options):
+    for count in (10, 1000, 10000):
+        processor = latextext.SvgProcessor(synthetic_document(count), processor_options())
+        layer = etree.SubElement(processor.docroot, 'g')
+        layer.attrib['id'] = 'ltx-render-layer'
+        processor.index_layer(layer)
+        for label in ("insert", "replace"):
+            renderings = [synthetic_rendering(i) for i in range(count)]
+            start = time.time()
+            for i, rendering in enumerate(renderings):
+                processor.insert_node(rendering, layer, 'lx-text%d' % i)
+            t = time.time() - start
+            print("%-24s %8.1f ms total   %8.3f ms per node" % ("%s %d nodes" % (label, count), t * 1000, t * 1000 / count))
+
+
+# stub Latex engine: writes the document body as the PDF or DVI file, the
+# metrics of the preview package into the log, and an empty format when
+# called with -ini. Every snippet is 5pt wide per character, 8pt high and
+# 2pt deep.
+STUB_LATEX = r"""
+import os, sys
+args = sys.argv[1:]
+outdir = [a.split('=', 1)[1] for a in args if a.startswith('-output-directory=')][0]
+jobname = os.path.splitext(os.path.basename(args[-1]))[0]
+for a in args:
+    if a.startswith('-jobname='):
+        jobname = a.split('=', 1)[1]
+if '-ini' in args:
+    open(os.path.join(outdir, jobname + '.fmt'), 'w').write('stub format')
+    sys.exit(0)
+src = open(args[-1]).read()
+body = src.split('\\begin{document}', 1)[1].split('\\end{document}', 1)[0]
+ext = 'dvi' if os.path.basename(sys.argv[0]) == 'latex' else 'pdf'
+open(os.path.join(outdir, jobname + '.' + ext), 'w').write(body)
+with open(os.path.join(outdir, jobname + '.log'), 'w') as log:
+    for n, page in enumerate(body.split('\\begin{preview}')[1:]):
+        text = page.strip().split('\n', 1)[1].rsplit('\n', 1)[0].strip()
+        log.write('Preview: Snippet %d ended.(%d+%dx%d)\n' % (n + 1, 8 * 65536, 2 * 65536, 5 * len(text) * 65536))
+"""
+
+# stub converter for pdf2svg and dvisvgm: writes one SVG file per preview
+# environment with a glyph for every distinct character of the snippet
+STUB_CONVERTER = r"""
+import os, sys
+args = sys.argv[1:]
+if os.path.basename(sys.argv[0]) == 'dvisvgm':
+    pattern = [a.split('=', 1)[1] for a in args if a.startswith('--output=')][0].replace('%p', '%d')
+    source = args[-1]
+else:
+    source, pattern = args[0], args[1]
+pages = open(source).read().split('\\begin{preview}')[1:]
+for n, page in enumerate(pages):
+    text = page.strip().split('\n', 1)[1].rsplit('\n', 1)[0].strip()
+    symbols = ''.join('<symbol overflow="visible" id="glyph0-%d"><path style="stroke:none;" '
+                      'd="M 0 0 L 0 -%d L 4 -%d L 4 0 Z"/></symbol>' % (ord(c), ord(c) % 7 + 1, ord(c) % 5 + 1)
+                      for c in sorted(set(text)))
+    uses = ''.join('<use xlink:href="#glyph0-%d" x="%d" y="8"/>' % (ord(c), 5 * i) for i, c in enumerate(text))
+    open(pattern % (n + 1), 'w').write(
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+        'width="%dpt" height="10pt" viewBox="0 0 %d 10" version="1.1">'
+        '<defs><g>%s</g></defs><g id="surface1"><g style="fill:rgb(0%%,0%%,0%%);">%s</g></g></svg>'
+        % (5 * len(text), 5 * len(text), symbols, uses))
+"""
+
+STUB_KPSEWHICH = r"""
+import os, sys
+print(os.path.abspath(sys.argv[0]))
+"""
+
+
+# write the stub executables into a directory and use them instead of the
+# installed tools
+def install_stubs(path):
+    stubs = {'pdflatex': STUB_LATEX, 'latex': STUB_LATEX, 'pdf2svg': STUB_CONVERTER,
+             'dvisvgm': STUB_CONVERTER, 'kpsewhich': STUB_KPSEWHICH}
+    for name, source in stubs.items():
+        stub_path = os.path.join(path, name)
+        with open(stub_path, 'w') as f:
+            f.write("#!%s\n%s" % (sys.executable, source))
+        os.chmod(stub_path, 0o755)
+    latextext.latex_command = lambda name: os.path.join(path, name)
+    latextext.pdf2svg_command = lambda: os.path.join(path, 'pdf2svg')
+
+
+STAGES = ['load', 'format', 'tex write', 'latex', 'convert', 'parse', 'align_placement',
+          'add_id_prefix', 'insert_node', 'serialize', 'total']
+
+
+# accumulates the time spent in the wrapped methods per stage
+class StageTimer:
+
+    def __init__(self):
+        self.totals = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+        self.patched = []
+
+    # stage is a name or a function which maps the arguments to a name
+    def wrap(self, owner, name, stage):
+        original = owner.__dict__[name]
+        totals = self.totals
+
+        def timed_method(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                key = stage(*args) if callable(stage) else stage
+                totals[key] = totals.get(key, 0.0) + time.time() - start
+        setattr(owner, name, timed_method)
+        self.patched.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+
+def command_stage(renderer, cmd, *args):
+    name = os.path.basename(cmd[0])
+    if '-ini' in cmd:
+        return 'format'
+    if name in ('pdflatex', 'latex'):
+        return 'latex'
+    if name in ('pdf2svg', 'dvisvgm'):
+        return 'convert'
+    return name
+
+
+# render a synthetic document with a cold cache and time every stage
+def bench_pipeline(options):
+    work_dir = tempfile.mkdtemp()
+    try:
+        if options.stub:
+            install_stubs(work_dir)
+        infile = os.path.join(work_dir, 'synthetic.svg')
+        synthetic_document(options.nodes, options.nesting, options.transforms,
+                           options.duplicates).write(infile)
+
+        timer = StageTimer()
+        timer.wrap(latextext.Latex2SvgRenderer, '_write_tex', 'tex write')
+        timer.wrap(latextext.Latex2SvgRenderer, '_exec_command', command_stage)
+        timer.wrap(latextext.Latex2SvgRenderer, '_read_pages', 'parse')
+        timer.wrap(latextext.SvgProcessor, 'align_placement', 'align_placement')
+        timer.wrap(latextext.SvgProcessor, 'add_id_prefix', 'add_id_prefix')
+        timer.wrap(latextext.SvgProcessor, 'insert_node', 'insert_node')
+
+        runs = []
+        try:
+            for n in range(options.repeat):
+                for stage in timer.totals:
+                    timer.totals[stage] = 0.0
+                cache = latextext.RenderCache(os.path.join(work_dir, 'cache-%d' % n))
+                processor_opts = processor_options(preamble=options.preamble, packages=options.packages,
+                                                   fontsize=options.fontsize, backend=options.backend,
+                                                   no_format=options.no_format)
+                start = time.time()
+                processor = latextext.SvgProcessor(infile, processor_opts, cache)
+                timer.totals['load'] = time.time() - start
+                result = processor.run()
+                serialize_start = time.time()
+                etree.tostring(result, pretty_print=True, xml_declaration=True)
+                timer.totals['serialize'] = time.time() - serialize_start
+                timer.totals['total'] = time.time() - start
+                runs.append(dict(timer.totals))
+        finally:
+            timer.restore()
+    finally:
+        shutil.rmtree(work_dir)
+
+    results = {
+        'config': {'nodes': options.nodes, 'nesting': options.nesting, 'transforms': options.transforms,
+                   'duplicates': options.duplicates, 'backend': options.backend, 'stub': options.stub,
+                   'format': not options.no_format},
+        'stages': collections.OrderedDict((stage, sorted(run.get(stage, 0.0) for run in runs))
+                                          for stage in timer.totals),
+    }
+    for stage, timings in results['stages'].items():
+        print_timings(stage, timings)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        return compare_results(baseline, results, options.tolerance)
+
+
+def median(timings):
+    return timings[len(timings) // 2] if timings else 0.0
+
+
+# print the change of every stage against a baseline, returns False if a
+# stage got slower than the tolerance allows
+def compare_results(baseline, results, tolerance):
+    if baseline.get('config') != results['config']:
+        print("\nWarning: the baseline was measured with a different configuration")
+    print("\n%-24s %12s %12s %9s" % ("stage", "baseline", "current", "change"))
+    ok = True
+    for stage, timings in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        before = median(baseline['stages'][stage])
+        after = median(timings)
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        # stages below a millisecond are too noisy to judge
+        regression = change > tolerance and after - before > 0.001
+        ok = ok and not regression
+        print("%-24s %9.1f ms %9.1f ms %+8.1f%%%s" % (stage, before * 1000, after * 1000, change,
+                                                     "  SLOWER" if regression else ""))
+    return ok
+
+
+BENCHMARKS = {
+    'format': bench_format,
+    'backends': bench_backends,
+    'insert': bench_insert,
+    'pipeline': bench_pipeline,
+}
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().split('\n\n', 1)[1])
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=3,
+                      help="number of passes over the snippet corpus (default: %default)")
+    parser.add_option("-p", "--preamble", dest="preamble",
+                      default=os.path.join(ROOT_PATH, 'preambles', 'mathpreamble.tex'),
+                      help="latex preamble file (default: %default)", metavar="FILE")
+    parser.add_option("-k", "--packages", dest="packages", default="amsmath,amssymb",
+                      help="comma separated list of latex packages (default: %default)", metavar="LIST")
+    parser.add_option("-f", "--fontsize", dest="fontsize", type="int", default=10,
+                      help="latex base font size (default: %default)")
+    parser.add_option("-b", "--backend", dest="backend", default="pdf2svg",
+                      choices=sorted(latextext.BACKENDS.keys()),
+                      help="render backend of the pipeline benchmark (default: %default)")
+    parser.add_option("--no-format", dest="no_format", action="store_true", default=False,
+                      help="do not precompile the preamble in the pipeline benchmark")
+    parser.add_option("--nodes", dest="nodes", type="int", default=200,
+                      help="number of text nodes of the synthetic document (default: %default)")
+    parser.add_option("--nesting", dest="nesting", type="int", default=0,
+                      help="number of groups around each text node (default: %default)")
+    parser.add_option("--transforms", dest="transforms", type="int", default=0,
+                      help="complexity of the transforms from 0 (none) to %d (default: %%default)"
+                           % (len(TRANSFORMS) - 1))
+    parser.add_option("--duplicates", dest="duplicates", type="float", default=0.0,
+                      help="ratio of text nodes repeating an earlier label (default: %default)")
+    parser.add_option("--stub", dest="stub", action="store_true", default=False,
+                      help="use stub executables with canned output instead of the Latex tools")
+    parser.add_option("--save", dest="save", metavar="FILE",
+                      help="save the results as JSON")
+    parser.add_option("--baseline", dest="baseline", metavar="FILE",
+                      help="compare the results to a saved baseline")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=10.0,
+                      help="allowed slowdown against the baseline in percent (default: %default)")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        parser.error("Unknown or missing benchmark")
+    if not 0 <= options.transforms < len(TRANSFORMS):
+        parser.error("--transforms has to be between 0 and %d" % (len(TRANSFORMS) - 1))
+    try:
+        if BENCHMARKS[args[0]](options) is False:
+            sys.exit(1)
+    except latextext.LatexError as err:
+        latextext.log_error(err.message)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()